@@ -0,0 +1,123 @@
+#	firewalld - Linux firewall daemon with time-based capabilities
+#	Copyright (C) 2020-2021 Johannes Bauer
+#
+#	This file is part of firewalld.
+#
+#	firewalld is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	firewalld is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with firewalld; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import os
+import sys
+import json
+import subprocess
+from pyipt.Tools import atomic_write
+
+class BootSnapshot():
+	"""The boot snapshot contains the last successfully applied ruleset in
+	iptables-restore format together with the inputs it was generated from.
+	On startup it can be applied before any of the expensive work (parsing
+	the JSON and /etc/services, querying interfaces, resolving DNS) is done.
+	This module therefore deliberately only imports the standard library and
+	none of the other pyipt modules except for the small Tools module."""
+	_STATIC_INPUTS = [ "/etc/services", "/etc/hosts" ]
+
+	def __init__(self, filename, ruleset_filename):
+		self._filename = filename
+		self._ruleset_filename = ruleset_filename
+
+	@staticmethod
+	def _file_mtime(filename):
+		try:
+			return round(os.stat(filename).st_mtime * 1000000)
+		except FileNotFoundError:
+			return None
+
+	@staticmethod
+	def _interface_addresses():
+		try:
+			ip_output = subprocess.check_output([ "ip", "-o", "addr", "show" ], stderr = subprocess.DEVNULL).decode("ascii")
+		except (FileNotFoundError, subprocess.CalledProcessError):
+			return None
+		addresses = [ ]
+		for line in ip_output.split("\n"):
+			fields = line.split()
+			if (len(fields) >= 4) and (fields[2] == "inet"):
+				addresses.append("%s %s" % (fields[1], fields[3]))
+		addresses.sort()
+		return addresses
+
+	def _current_inputs(self, input_files, mock_interfaces):
+		inputs = {
+			"files": { filename: self._file_mtime(filename) for filename in input_files },
+		}
+		if not mock_interfaces:
+			inputs["interfaces"] = self._interface_addresses()
+		return inputs
+
+	def save(self, ruleset):
+		mock_dirname = ruleset.metadata["source"].get("options", { }).get("mock_interfaces")
+		input_files = ruleset.metadata.get("ruleset_files", [ self._ruleset_filename ]) + self._STATIC_INPUTS
+		if mock_dirname is not None:
+			try:
+				input_files += sorted(mock_dirname + "/" + filename for filename in os.listdir(mock_dirname))
+			except FileNotFoundError:
+				pass
+		# Sets are created empty (with -exist) so that rules referring to them
+		# can be restored, they are filled once the daemon is running
+		ipset_commands = [ ]
+		for source in ruleset.metadata.get("feeds", [ ]) + ruleset.metadata.get("dynamic_sets", [ ]) + ruleset.metadata.get("fqdn_sets", [ ]):
+			ipset_commands.append(source.ipset.create_command())
+		snapshot = {
+			"hash":		ruleset.hash(),
+			"ipsets":	ipset_commands,
+			"tc":		[ commands for (device, commands) in ruleset.generate_tc() ],
+			"inputs":	self._current_inputs(input_files, mock_interfaces = mock_dirname is not None),
+			"restore":	list(ruleset.generate_restore()),
+		}
+		with atomic_write(self._filename) as f:
+			json.dump(snapshot, f)
+
+	def apply(self):
+		"""Applies the boot snapshot if all inputs it depended on are still
+		unchanged. Returns the hash of the applied ruleset or None if the
+		snapshot was not applied."""
+		try:
+			with open(self._filename) as f:
+				snapshot = json.load(f)
+		except (FileNotFoundError, json.decoder.JSONDecodeError):
+			return None
+
+		inputs = snapshot["inputs"]
+		if self._ruleset_filename not in inputs["files"]:
+			print("Boot snapshot was created from a different ruleset, not applying it.", file = sys.stderr)
+			return None
+		if self._current_inputs(list(inputs["files"]), mock_interfaces = "interfaces" not in inputs) != inputs:
+			print("Boot snapshot inputs have changed, not applying it.", file = sys.stderr)
+			return None
+
+		print("Applying boot snapshot (hash %s)." % (snapshot["hash"]), file = sys.stderr)
+		restore_data = "".join(line + "\n" for line in snapshot["restore"]).encode("utf-8")
+		try:
+			for command in snapshot.get("ipsets", [ ]):
+				subprocess.check_call(command)
+			for commands in snapshot.get("tc", [ ]):
+				for command in commands:
+					subprocess.check_call(command)
+			subprocess.run([ "iptables-restore", "--noflush" ], input = restore_data, check = True)
+		except (FileNotFoundError, subprocess.CalledProcessError) as e:
+			print("Failed to apply boot snapshot: %s" % (str(e)), file = sys.stderr)
+			return None
+		return snapshot["hash"]
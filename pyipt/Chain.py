@@ -38,10 +38,10 @@ class Chain():
 			(table, chain) = text.split(".", maxsplit = 1)
 			return cls(table, chain)
 		else:
-			return cls("mangle", text)
+			return cls("filter", text)
 
 	def command(self, option):
-		if self.table == "mangle":
+		if self.table == "filter":
 			return (option, self.chain.upper())
 		else:
 			return ("-t", self.table.lower(), option, self.chain.upper())
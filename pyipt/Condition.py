@@ -24,10 +24,20 @@ from pyipt.TimeWindow import TimeWindow
 class Condition():
 	def __init__(self, condition_dict):
 		self._conditions = [ ]
+		self._time_windows = [ ]
 		if "timewindow" in condition_dict:
 			time_window = TimeWindow.parse(condition_dict["timewindow"])
+			self._time_windows.append(time_window)
 			self._conditions.append(lambda meta: time_window.satisfied(meta["now"]))
 
+	def boundaries(self):
+		"""Returns the seconds of the week at which the condition might
+		change."""
+		seconds = set()
+		for time_window in self._time_windows:
+			seconds |= time_window.boundaries()
+		return seconds
+
 	def satisfied(self, metadata):
 		for condition in self._conditions:
 			if not condition(metadata):
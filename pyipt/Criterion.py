@@ -21,22 +21,53 @@
 
 import enum
 from pyipt.Tools import multisplit
+from pyipt.RateLimit import RateLimit
+from pyipt.Matches import StateMatch, StringMatch, ConnLimitMatch
+from pyipt.Exceptions import InvalidRateLimitException, UnknownTypeError
 
 class CriterionType(enum.Enum):
 	State = "state"
 	DNSBlock = "dns-block"
+	HashLimit = "hashlimit"
+	ConnLimit = "connlimit"
 
 class Criterion():
+	_STATES = {
+		"established/related":	[ "ESTABLISHED", "RELATED" ],
+		"untracked":			[ "UNTRACKED" ],
+	}
+	_CONNLIMIT_PER = set([ "src", "dst" ])
+
 	def __init__(self, criterion_dict):
 		self._criterion = criterion_dict
 		self._type = CriterionType(self._criterion["type"])
+		if self._type == CriterionType.State:
+			if self._criterion.get("state") not in self._STATES:
+				raise UnknownTypeError("state criterion must be one of %s: %s" % (", ".join(sorted(self._STATES)), str(self._criterion)))
+		elif self._type == CriterionType.HashLimit:
+			# Limits the rate of new connections, per source address unless
+			# specified otherwise
+			limit = { key: value for (key, value) in self._criterion.items() if key != "type" }
+			if "per" not in limit:
+				limit["per"] = "src"
+			self._rate_limit = RateLimit(limit)
+		elif self._type == CriterionType.ConnLimit:
+			if not isinstance(self._criterion.get("limit"), int):
+				raise InvalidRateLimitException("connlimit criterion requires an integer 'limit': %s" % (str(self._criterion)))
+			if self._criterion.get("per", "src") not in self._CONNLIMIT_PER:
+				raise InvalidRateLimitException("connlimit 'per' must be one of %s: %s" % (", ".join(sorted(self._CONNLIMIT_PER)), str(self._criterion)))
+
+	@property
+	def matches_untracked(self):
+		"""False if the criterion restricts to a connection state that packets
+		exempted from connection tracking never have."""
+		if self._type == CriterionType.State:
+			return "UNTRACKED" in self._STATES[self._criterion["state"]]
+		return self._type != CriterionType.HashLimit
 
 	def apply(self, rule):
 		if self._type == CriterionType.State:
-			if self._criterion["state"] == "established/related":
-				rule.add_fixed(("--match", "state", "--state", "ESTABLISHED,RELATED"))
-			else:
-				raise NotImplementedError(self._criterion["state"])
+			rule.add_fixed((StateMatch(self._STATES[self._criterion["state"]]), ))
 		elif self._type == CriterionType.DNSBlock:
 			hostname_str = self._criterion["dns-name"]
 			group = rule.add_group("layer7 DNS blocking")
@@ -47,6 +78,12 @@ class Criterion():
 					label = label.encode("ascii")
 					dns_pkt_data.append(len(label))
 					dns_pkt_data += label
-				group.append(("--match", "string", "--hex-string", "|%s|" % (dns_pkt_data.hex()), "--algo", "bm", "--icase"))
+				group.append((StringMatch(bytes(dns_pkt_data)), ))
+		elif self._type == CriterionType.HashLimit:
+			rule.add_fixed((StateMatch([ "NEW" ]), self._rate_limit.match()))
+		elif self._type == CriterionType.ConnLimit:
+			# Matches as long as there are at most 'limit' concurrent
+			# connections, further connections fall through to the next rule
+			rule.add_fixed((ConnLimitMatch(self._criterion["limit"], self._criterion.get("mask"), self._criterion.get("per", "src")), ))
 		else:
 			raise NotImplementedError(self._type)
@@ -0,0 +1,148 @@
+#	firewalld - Linux firewall daemon with time-based capabilities
+#	Copyright (C) 2020-2021 Johannes Bauer
+#
+#	This file is part of firewalld.
+#
+#	firewalld is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	firewalld is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with firewalld; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import struct
+import collections
+from pyipt.Exceptions import MalformedPacketException
+
+ResourceRecord = collections.namedtuple("ResourceRecord", [ "name", "rtype", "ttl", "data" ])
+
+class DNSMessage():
+	"""Minimal parser of DNS messages (RFC 1035) that extracts the questions
+	and all A and CNAME records of the answer section. Names are returned in
+	lower case without trailing dot."""
+	TYPE_A = 1
+	TYPE_CNAME = 5
+	_MAX_POINTERS = 32
+
+	def __init__(self, data):
+		self._data = data
+		if len(data) < 12:
+			raise MalformedPacketException("DNS message too short (%d bytes)." % (len(data)))
+		(self._msgid, self._flags, qdcount, ancount) = struct.unpack(">HHHH", data[:8])
+		offset = 12
+		self._questions = [ ]
+		for i in range(qdcount):
+			(name, offset) = self._parse_name(offset)
+			(qtype, ) = struct.unpack(">H", self._slice(offset, 2))
+			self._questions.append((name, qtype))
+			offset += 4
+		self._answers = [ ]
+		for i in range(ancount):
+			(name, offset) = self._parse_name(offset)
+			(rtype, rclass, ttl, rdlength) = struct.unpack(">HHLH", self._slice(offset, 10))
+			offset += 10
+			rdata = self._slice(offset, rdlength)
+			if rtype == self.TYPE_A:
+				if rdlength != 4:
+					raise MalformedPacketException("A record with %d bytes of data." % (rdlength))
+				self._answers.append(ResourceRecord(name, rtype, ttl, ".".join(str(octet) for octet in rdata)))
+			elif rtype == self.TYPE_CNAME:
+				self._answers.append(ResourceRecord(name, rtype, ttl, self._parse_name(offset)[0]))
+			offset += rdlength
+
+	def _slice(self, offset, length):
+		if offset + length > len(self._data):
+			raise MalformedPacketException("DNS message truncated at offset %d." % (offset))
+		return self._data[offset : offset + length]
+
+	def _parse_name(self, offset):
+		"""Returns the name at the given offset and the offset following it.
+		Compression pointers are followed."""
+		labels = [ ]
+		end_offset = None
+		for i in range(self._MAX_POINTERS):
+			while True:
+				length = self._slice(offset, 1)[0]
+				if length == 0:
+					offset += 1
+					if end_offset is None:
+						end_offset = offset
+					return (".".join(labels).lower(), end_offset)
+				elif (length & 0xc0) == 0xc0:
+					if end_offset is None:
+						end_offset = offset + 2
+					offset = ((length & 0x3f) << 8) | self._slice(offset + 1, 1)[0]
+					break
+				labels.append(self._slice(offset + 1, length).decode("ascii", errors = "replace"))
+				offset += 1 + length
+		raise MalformedPacketException("Too many compression pointers in DNS name.")
+
+	@property
+	def is_response(self):
+		return (self._flags & 0x8000) != 0
+
+	@property
+	def rcode(self):
+		return self._flags & 0xf
+
+	@property
+	def questions(self):
+		return self._questions
+
+	@property
+	def answers(self):
+		return self._answers
+
+	@property
+	def names(self):
+		"""All names on the CNAME chains that start at the questions. Records
+		of any other name in the answer section were not asked for and are
+		never trusted."""
+		names = set()
+		pending = [ name for (name, qtype) in self._questions ]
+		while len(pending) > 0:
+			current = pending.pop()
+			if current in names:
+				continue
+			names.add(current)
+			pending += [ record.data for record in self._answers if (record.name == current) and (record.rtype == self.TYPE_CNAME) ]
+		return names
+
+	def addresses(self, name):
+		"""Follows the CNAME chain starting at 'name' and returns a dictionary
+		of all IPv4 addresses it ends in, each with the smallest TTL along the
+		chain."""
+		addresses = { }
+		pending = [ (name, None) ]
+		visited = set()
+		while len(pending) > 0:
+			(current, ttl) = pending.pop()
+			if current in visited:
+				continue
+			visited.add(current)
+			for record in self._answers:
+				if record.name != current:
+					continue
+				record_ttl = record.ttl if (ttl is None) else min(ttl, record.ttl)
+				if record.rtype == self.TYPE_CNAME:
+					pending.append((record.data, record_ttl))
+				elif record_ttl < addresses.get(record.data, record_ttl + 1):
+					addresses[record.data] = record_ttl
+		return addresses
+
+if __name__ == "__main__":
+	# Response for www.reddit.com: CNAME reddit.map.fastly.net, two A records
+	msg = DNSMessage(bytes.fromhex("1a2b81800001000300000000037777770672656464697403636f6d0000010001c00c0005000100000e10001706726564646974036d617006666173746c79036e657400c02c000100010000001e0004976580c1c02c000100010000001e0004976540c1"))
+	print(msg.questions)
+	for record in msg.answers:
+		print(record)
+	print(msg.addresses("www.reddit.com"))
@@ -0,0 +1,96 @@
+#	firewalld - Linux firewall daemon with time-based capabilities
+#	Copyright (C) 2020-2021 Johannes Bauer
+#
+#	This file is part of firewalld.
+#
+#	firewalld is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	firewalld is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with firewalld; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import sys
+import struct
+from pyipt.DNSMessage import DNSMessage
+from pyipt.Exceptions import MalformedPacketException
+
+class DNSSnooper():
+	"""Extracts the addresses of configured domain names from DNS responses
+	that were logged via NFLOG (or recorded earlier). Every IPv4 address a
+	question resolves to, directly or through CNAMEs, is reported for each
+	FqdnSet that matches a name of the chain, together with the timeout of
+	the entry: the TTL of the answer, clamped to [min_ttl, max_ttl]. Answers
+	for names that were not asked for are ignored.
+
+	Whoever can get a UDP packet from port 53 logged can add addresses to
+	the sets, so the NFLOG rule must only match responses of the trusted
+	resolver (see FqdnSet.snoop_options)."""
+	_PROTO_UDP = 17
+	_DNS_PORT = 53
+
+	def __init__(self, fqdn_sets, min_ttl, max_ttl):
+		self._fqdn_sets = fqdn_sets
+		self._min_ttl = min_ttl
+		self._max_ttl = max_ttl
+
+	@classmethod
+	def dns_payload(cls, packet):
+		"""Returns the DNS message of an IPv4 UDP packet from port 53 or None
+		for any other packet."""
+		if (len(packet) < 20) or ((packet[0] >> 4) != 4) or (packet[9] != cls._PROTO_UDP):
+			return None
+		header_length = 4 * (packet[0] & 0xf)
+		if len(packet) < header_length + 8:
+			raise MalformedPacketException("UDP packet truncated (%d bytes)." % (len(packet)))
+		(sport, dport, length) = struct.unpack(">HHH", packet[header_length : header_length + 6])
+		if sport != cls._DNS_PORT:
+			return None
+		return packet[header_length + 8 : header_length + length]
+
+	def process_packet(self, packet):
+		"""Returns a list of (fqdn_set, address, timeout) tuples for the
+		answers of a packet."""
+		payload = self.dns_payload(packet)
+		if payload is None:
+			return [ ]
+		msg = DNSMessage(payload)
+		if (not msg.is_response) or (msg.rcode != 0):
+			return [ ]
+		updates = { }
+		for name in sorted(msg.names):
+			for fqdn_set in self._fqdn_sets:
+				if fqdn_set.matches(name):
+					for (address, ttl) in msg.addresses(name).items():
+						timeout = min(max(ttl, self._min_ttl), self._max_ttl)
+						key = (fqdn_set.fqdn, address)
+						if (key not in updates) or (updates[key][2] < timeout):
+							updates[key] = (fqdn_set, address, timeout)
+		return [ updates[key] for key in sorted(updates) ]
+
+	def updates(self, packets):
+		"""Yields the updates of all packets. Malformed packets are reported
+		and skipped."""
+		for packet in packets:
+			try:
+				yield from self.process_packet(packet)
+			except MalformedPacketException as e:
+				print("Warning: Ignoring malformed DNS response: %s" % (str(e)), file = sys.stderr)
+
+if __name__ == "__main__":
+	# Recorded response 192.168.1.1:53 -> 192.168.1.2 for www.reddit.com (CNAME
+	# reddit.map.fastly.net with two A records, TTL 30)
+	from pyipt.FqdnSet import FqdnSet
+	packet = bytes.fromhex("4500007f0000000040110000c0a80101c0a8010200359c40006b00001a2b81800001000300000000037777770672656464697403636f6d0000010001c00c0005000100000e10001706726564646974036d617006666173746c79036e657400c02c000100010000001e0004976580c1c02c000100010000001e0004976540c1")
+	snooper = DNSSnooper([ FqdnSet("www.reddit.com", 86400), FqdnSet("*.fastly.net", 86400) ], min_ttl = 60, max_ttl = 86400)
+	for (fqdn_set, address, timeout) in snooper.updates([ packet ]):
+		print("%-25s %-16s timeout %d" % (fqdn_set.fqdn, address, timeout))
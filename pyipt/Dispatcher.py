@@ -0,0 +1,157 @@
+#	firewalld - Linux firewall daemon with time-based capabilities
+#	Copyright (C) 2020-2021 Johannes Bauer
+#
+#	This file is part of firewalld.
+#
+#	firewalld is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	firewalld is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with firewalld; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import hashlib
+from pyipt.Rules import Rules, Ruleset
+from pyipt.Matches import InterfaceMatch, ProtocolMatch, PortMatch, ICMPTypeMatch, Goto
+from pyipt.Tools import multisplit
+from pyipt.Exceptions import UnknownTypeError
+
+class Dispatcher():
+	"""Splits the rules of a chain into sub-chains per input interface (and
+	optionally per protocol) so that a packet only walks the rules which can
+	possibly match it. The original chain starts with a short dispatch
+	header of '-i <interface> -g <sub-chain>' rules. Every sub-chain
+	contains, in their original order, all rules that can match packets
+	from that interface: those for the interface itself and all rules that
+	do not restrict the interface, or only do so by negation or wildcard.
+	The latter also remain in the original chain after the dispatch header
+	for packets from all other interfaces. Since the sub-chains are entered
+	with goto, a packet that is not decided within its sub-chain gets the
+	policy of the original chain and never sees any rule twice, so
+	first-match semantics are unchanged."""
+	_DISPATCH_OPTIONS = set([ "interface", "proto" ])
+	# Sub-chains may themselves be shadowed, leave room for the suffix
+	_MAX_SUBCHAIN_NAME_LENGTH = Ruleset.MAX_CHAIN_NAME_LENGTH - Ruleset.SHADOW_SUFFIX_LENGTH
+
+	def __init__(self, chain, dispatch_str):
+		self._chain = chain
+		self._options = [ ]
+		for dispatch_option in multisplit(dispatch_str):
+			if dispatch_option not in self._DISPATCH_OPTIONS:
+				raise UnknownTypeError("Unknown dispatch option '%s' for chain %s, must be one of %s." % (dispatch_option, str(chain), ", ".join(sorted(self._DISPATCH_OPTIONS))))
+			self._options.append(dispatch_option)
+
+	@classmethod
+	def _subchain_name(cls, chain, key):
+		name = "%s_%s" % (chain, key)
+		if len(name) > cls._MAX_SUBCHAIN_NAME_LENGTH:
+			name = "%s_%s" % (chain[:cls._MAX_SUBCHAIN_NAME_LENGTH - 9], hashlib.md5(name.encode("utf-8")).hexdigest()[:8])
+		return name
+
+	@staticmethod
+	def _find_option(tokens, option):
+		"""Returns the input interface or protocol a rule is restricted to
+		and whether it was negated."""
+		for token in tokens:
+			if option == "interface":
+				if isinstance(token, InterfaceMatch) and (token.direction == "in"):
+					return (token.name, token.negated)
+			elif isinstance(token, (ProtocolMatch, PortMatch)):
+				return (token.proto, False)
+			elif isinstance(token, ICMPTypeMatch):
+				return ("icmp", False)
+		return (None, False)
+
+	@staticmethod
+	def _dispatch_match(option, key):
+		if option == "interface":
+			return InterfaceMatch("in", key)
+		else:
+			return ProtocolMatch(key)
+
+	def _split(self, prefix, chain, entries, options):
+		"""Returns the list of (name, tokens) tuples that implement the given
+		rule entries in 'chain', dispatched by the given options. Entries are
+		(name, tokens) tuples, where tokens are the Match objects following
+		the '-A <chain>'."""
+		if len(options) == 0:
+			return [ (name, prefix + [ "-A", chain ] + tokens) for (name, tokens) in entries ]
+
+		option = options[0]
+		keys = [ ]
+		for (name, tokens) in entries:
+			(value, negated) = self._find_option(tokens, option)
+			if (value is not None) and (not negated) and (not value.endswith("+")) and (value not in keys):
+				keys.append(value)
+		if len(keys) == 0:
+			return self._split(prefix, chain, entries, options[1:])
+
+		sub_entries = { key: [ ] for key in keys }
+		generic_entries = [ ]
+		for (name, tokens) in entries:
+			(value, negated) = self._find_option(tokens, option)
+			if value is None:
+				targets = keys
+			elif negated and value.endswith("+"):
+				targets = [ key for key in keys if not key.startswith(value[:-1]) ]
+			elif negated:
+				targets = [ key for key in keys if key != value ]
+			elif value.endswith("+"):
+				targets = [ key for key in keys if key.startswith(value[:-1]) ]
+			else:
+				sub_entries[value].append((name, tokens))
+				continue
+			for target in targets:
+				sub_entries[target].append((name, tokens))
+			generic_entries.append((name, tokens))
+
+		dispatch_name = "dispatch %s by %s" % (chain, option)
+		result = [ ]
+		for key in keys:
+			subchain = self._subchain_name(chain, key)
+			result.append((dispatch_name, prefix + [ "-N", subchain ]))
+			result += self._split(prefix, subchain, sub_entries[key], options[1:])
+		for key in keys:
+			result.append((dispatch_name, prefix + [ "-A", chain, self._dispatch_match(option, key), Goto(self._subchain_name(chain, key)) ]))
+		result += self._split(prefix, chain, generic_entries, options[1:])
+		return result
+
+	def apply(self, ruleset):
+		"""Replaces all rules of the chain in the ruleset by their dispatched
+		equivalent. Rules of other chains are left untouched."""
+		append = self._chain.iptables_append()
+		prefix = list(append[:-2])
+		new_rules = [ ]
+		entries = [ ]
+		dispatch_position = None
+		for rules in ruleset.rules:
+			kept_rules = Rules(rules.name)
+			for rule in rules:
+				irs = list(rule.generate_ir())
+				if (len(irs) > 0) and (tuple(irs[0][:len(append)]) == append):
+					entries += [ (rules.name, tokens[len(append):]) for tokens in irs ]
+					if dispatch_position is None:
+						dispatch_position = len(new_rules)
+				else:
+					kept_rules.append(rule)
+			if len(kept_rules) > 0:
+				new_rules.append(kept_rules)
+		if dispatch_position is None:
+			return
+
+		dispatched_rules = [ ]
+		for (name, tokens) in self._split(prefix, self._chain.chain.upper(), entries, self._options):
+			if (len(dispatched_rules) == 0) or (dispatched_rules[-1].name != name):
+				dispatched_rules.append(Rules(name))
+			dispatched_rules[-1].new().add_fixed(tuple(tokens))
+		new_rules[dispatch_position : dispatch_position] = dispatched_rules
+		ruleset.replace_rules(new_rules)
@@ -0,0 +1,93 @@
+#	firewalld - Linux firewall daemon with time-based capabilities
+#	Copyright (C) 2020-2021 Johannes Bauer
+#
+#	This file is part of firewalld.
+#
+#	firewalld is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	firewalld is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with firewalld; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+from pyipt.IPSet import IPSet, IPSetReference
+from pyipt.NetworkAggregator import NetworkAggregator
+from pyipt.Exceptions import InvalidSetException
+
+class DynamicSet():
+	"""A dynamic set is an ipset whose members are not part of the ruleset
+	but are added and removed at runtime, e.g., to ban abusive clients.
+	Every change is a single kernel update of the set; the ruleset is not
+	regenerated. Entries may expire in the kernel after a timeout. The set is
+	only ever created, never flushed, so its members survive any number of
+	reapplies of the ruleset."""
+	_SET_PREFIX = "fwdyn_"
+	_KNOWN_KEYS = set([ "timeout" ])
+
+	def __init__(self, name, definition):
+		unknown_keys = set(definition) - self._KNOWN_KEYS
+		if len(unknown_keys) > 0:
+			raise InvalidSetException("Unknown option(s) %s for set %s." % (", ".join(sorted(unknown_keys)), name))
+		timeout = definition.get("timeout", 0)
+		if (not isinstance(timeout, int)) or (timeout < 0):
+			raise InvalidSetException("Timeout of set %s must be a non-negative integer: %s" % (name, str(timeout)))
+		self._name = name
+		self._definition = definition
+		self._ipset = IPSet(self.set_name(name), timeout = timeout)
+
+	@classmethod
+	def set_name(cls, name):
+		return IPSet.derived_name(cls._SET_PREFIX, name)
+
+	@property
+	def name(self):
+		return self._name
+
+	@property
+	def definition(self):
+		return self._definition
+
+	@property
+	def ipset(self):
+		return self._ipset
+
+	@staticmethod
+	def _normalize(entry):
+		(first, last) = NetworkAggregator.parse_network(entry)
+		cidr = 32 - (last - first).bit_length()
+		return NetworkAggregator.format_network(first, cidr)
+
+	def ensure(self):
+		self._ipset.create()
+
+	def add(self, entry, timeout = None):
+		self.ensure()
+		self._ipset.add(self._normalize(entry), timeout = timeout)
+
+	def delete(self, entry):
+		self.ensure()
+		self._ipset.delete(self._normalize(entry))
+
+	def entries(self):
+		self.ensure()
+		return self._ipset.entries()
+
+	def script_commands(self):
+		yield " ".join(self._ipset.create_command())
+
+class SetReference(IPSetReference):
+	"""Refers to one or more dynamic sets from within a rule."""
+	@classmethod
+	def _set_name(cls, name, config):
+		if name not in config.get("sets", { }):
+			raise InvalidSetException("Unknown set: %s" % (name))
+		return DynamicSet.set_name(name)
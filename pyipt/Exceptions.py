@@ -29,3 +29,11 @@ class UnknownPseudoRuleException(FirewallRulesetException): pass
 class AmbiguousServiceException(FirewallRulesetException): pass
 class InvalidTimeWindowException(FirewallRulesetException): pass
 class UnknownTypeError(FirewallRulesetException): pass
+class InvalidRateLimitException(FirewallRulesetException): pass
+class InvalidIncludeException(FirewallRulesetException): pass
+class InvalidNetworkException(FirewallRulesetException): pass
+class InvalidFeedException(FirewallRulesetException): pass
+class InvalidSetException(FirewallRulesetException): pass
+class InvalidQoSException(FirewallRulesetException): pass
+class MalformedPacketException(Exception): pass
+class InvalidFqdnException(FirewallRulesetException): pass
@@ -0,0 +1,113 @@
+#	firewalld - Linux firewall daemon with time-based capabilities
+#	Copyright (C) 2020-2021 Johannes Bauer
+#
+#	This file is part of firewalld.
+#
+#	firewalld is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	firewalld is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with firewalld; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import os
+from pyipt.IPSet import IPSet, IPSetReference
+from pyipt.NetworkAggregator import NetworkAggregator
+from pyipt.Exceptions import InvalidFeedException
+
+class Feed():
+	"""A feed is a (potentially very large) list of addresses and networks in
+	a local file, e.g., a threat intelligence blocklist. Instead of turning
+	every entry into an iptables rule, the list is aggregated and loaded into
+	a hash:net ipset that rules match against with a single rule. The file is
+	only read again when it changed and an updated feed is applied to the
+	ipset as a diff, without touching any iptables chain."""
+	_SET_PREFIX = "fwfeed_"
+
+	def __init__(self, name, definition):
+		if "file" not in definition:
+			raise InvalidFeedException("Feed %s requires a 'file' to read from." % (name))
+		self._name = name
+		self._filename = definition["file"]
+		self._ipset = IPSet(self.set_name(name))
+		self._file_state = None
+		self._networks = None
+		self._synced_networks = None
+
+	@classmethod
+	def set_name(cls, name):
+		return IPSet.derived_name(cls._SET_PREFIX, name)
+
+	@property
+	def name(self):
+		return self._name
+
+	@property
+	def filename(self):
+		return self._filename
+
+	@property
+	def ipset(self):
+		return self._ipset
+
+	def networks(self):
+		"""Returns the aggregated networks of the feed, reading the file again
+		only if it was modified since it was last read."""
+		try:
+			stat = os.stat(self._filename)
+			file_state = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+			if file_state != self._file_state:
+				aggregator = NetworkAggregator()
+				aggregator.add_file(self._filename)
+				self._networks = list(aggregator)
+				self._file_state = file_state
+		except FileNotFoundError:
+			raise InvalidFeedException("File %s of feed %s does not exist." % (self._filename, self._name))
+		except OSError as e:
+			raise InvalidFeedException("File %s of feed %s cannot be read: %s" % (self._filename, self._name, str(e)))
+		return self._networks
+
+	def sync(self):
+		"""Loads the current feed content into the ipset. Returns the number
+		of added and removed entries or None if the ipset was already up to
+		date. If the file cannot be read (e.g., because it is just being
+		replaced), the ipset keeps its current content; it is only created
+		empty if it does not exist yet, so rules can still refer to it."""
+		try:
+			networks = self.networks()
+		except InvalidFeedException:
+			self._ipset.create()
+			raise
+		if networks is self._synced_networks:
+			return None
+		result = self._ipset.update(networks)
+		self._synced_networks = networks
+		return result
+
+	def script_commands(self):
+		"""Yields shell commands which create the ipset and load the feed into
+		it, for use in a firewall script."""
+		restore_commands = self._ipset.restore_commands(self.networks())
+		yield "ipset restore -exist <<'EOF'"
+		yield next(restore_commands)
+		# The set may still be referenced by the previous ruleset
+		yield "flush %s" % (self._ipset.name)
+		yield from restore_commands
+		yield "EOF"
+
+class FeedReference(IPSetReference):
+	"""Refers to one or more feeds from within a rule."""
+	@classmethod
+	def _set_name(cls, name, config):
+		if name not in config.get("feeds", { }):
+			raise InvalidFeedException("Unknown feed: %s" % (name))
+		return Feed.set_name(name)
@@ -0,0 +1,212 @@
+#	firewalld - Linux firewall daemon with time-based capabilities
+#	Copyright (C) 2020-2021 Johannes Bauer
+#
+#	This file is part of firewalld.
+#
+#	firewalld is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	firewalld is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with firewalld; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import os
+import sys
+import time
+import errno
+import struct
+import select
+import ctypes
+
+class FileWatcher():
+	"""Watches a set of files and directories for modification. Files are
+	watched through their parent directory so that editors which write a
+	temporary file and rename it over the original are noticed as well. For
+	watched directories, a change to any file inside of them counts. When
+	inotify is not available, the files are polled using stat() instead.
+
+	A burst of changes (e.g., an editor writing a file multiple times or a
+	configuration management run touching several files) is reported only
+	once, after no further change happened for the debounce time."""
+	_IN_MODIFY = 0x00000002
+	_IN_ATTRIB = 0x00000004
+	_IN_CLOSE_WRITE = 0x00000008
+	_IN_MOVED_FROM = 0x00000040
+	_IN_MOVED_TO = 0x00000080
+	_IN_CREATE = 0x00000100
+	_IN_DELETE = 0x00000200
+	_IN_NONBLOCK = 0o4000
+	_IN_CLOEXEC = 0o2000000
+	_WATCH_MASK = _IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+	_EVENT_HEADER = struct.Struct("iIII")
+
+	def __init__(self, paths = None, debounce_time = 1, poll_time = 5):
+		self._debounce_time = debounce_time
+		self._poll_time = poll_time
+		self._paths = set()
+		self._watched_dirs = { }
+		self._wd_dirs = { }
+		self._libc = None
+		self._fd = None
+		self._stat_snapshot = None
+		self._init_inotify()
+		if paths is not None:
+			self.update(paths)
+
+	@property
+	def uses_inotify(self):
+		return self._fd is not None
+
+	def _init_inotify(self):
+		try:
+			self._libc = ctypes.CDLL(None, use_errno = True)
+			fd = self._libc.inotify_init1(self._IN_NONBLOCK | self._IN_CLOEXEC)
+		except (OSError, AttributeError) as e:
+			print("Warning: inotify not available, polling files instead: %s" % (str(e)), file = sys.stderr)
+			return
+		if fd < 0:
+			print("Warning: inotify not available, polling files instead: %s" % (os.strerror(ctypes.get_errno())), file = sys.stderr)
+			return
+		self._fd = fd
+
+	def _add_watch(self, dirname):
+		wd = self._libc.inotify_add_watch(self._fd, os.fsencode(dirname), self._WATCH_MASK)
+		if wd < 0:
+			error = ctypes.get_errno()
+			if error != errno.ENOENT:
+				print("Warning: Unable to watch %s: %s" % (dirname, os.strerror(error)), file = sys.stderr)
+			return
+		self._wd_dirs[wd] = dirname
+
+	def update(self, paths):
+		"""Sets the paths that are watched. Watches are only added for
+		directories which were not watched before."""
+		paths = set(os.path.abspath(path) for path in paths)
+		if paths == self._paths:
+			return
+		self._paths = paths
+		self._watched_dirs = { }
+		for path in self._paths:
+			if os.path.isdir(path):
+				self._watched_dirs[path] = None
+			else:
+				(dirname, basename) = os.path.split(path)
+				if self._watched_dirs.get(dirname, set()) is not None:
+					self._watched_dirs.setdefault(dirname, set()).add(basename)
+
+		if self.uses_inotify:
+			known_dirs = set(self._wd_dirs.values())
+			for dirname in sorted(self._watched_dirs):
+				if dirname not in known_dirs:
+					self._add_watch(dirname)
+		self._stat_snapshot = self._stat_all()
+
+	def _matches(self, dirname, basename):
+		if dirname not in self._watched_dirs:
+			return False
+		basenames = self._watched_dirs[dirname]
+		return (basenames is None) or (basename in basenames)
+
+	def _read_events(self, timeout):
+		"""Returns the set of watched paths that were changed according to
+		inotify events received within the timeout. Events for other files
+		in the watched directories are skipped."""
+		changed = set()
+		end_time = time.time() + timeout
+		while len(changed) == 0:
+			remaining = end_time - time.time()
+			(readable, _, _) = select.select([ self._fd ], [ ], [ ], max(remaining, 0))
+			if len(readable) == 0:
+				break
+			try:
+				data = os.read(self._fd, 65536)
+			except BlockingIOError:
+				continue
+			offset = 0
+			while offset < len(data):
+				(wd, mask, cookie, name_length) = self._EVENT_HEADER.unpack_from(data, offset)
+				offset += self._EVENT_HEADER.size
+				basename = os.fsdecode(data[offset : offset + name_length].rstrip(b"\x00"))
+				offset += name_length
+				dirname = self._wd_dirs.get(wd)
+				if (dirname is not None) and self._matches(dirname, basename):
+					changed.add(os.path.join(dirname, basename))
+		return changed
+
+	@staticmethod
+	def _stat(path):
+		try:
+			result = os.stat(path)
+		except FileNotFoundError:
+			return None
+		return (result.st_ino, result.st_size, result.st_mtime_ns)
+
+	def _stat_all(self):
+		snapshot = { }
+		for (dirname, basenames) in self._watched_dirs.items():
+			if basenames is None:
+				try:
+					basenames = os.listdir(dirname)
+				except FileNotFoundError:
+					basenames = [ ]
+			for basename in basenames:
+				path = os.path.join(dirname, basename)
+				snapshot[path] = self._stat(path)
+		return snapshot
+
+	def _poll_changes(self):
+		snapshot = self._stat_all()
+		changed = set(path for path in set(snapshot) | set(self._stat_snapshot) if snapshot.get(path) != self._stat_snapshot.get(path))
+		self._stat_snapshot = snapshot
+		return changed
+
+	def _wait_change(self, timeout):
+		if self.uses_inotify:
+			return self._read_events(timeout)
+		changed = set()
+		end_time = time.time() + timeout
+		while True:
+			changed = self._poll_changes()
+			remaining = end_time - time.time()
+			if (len(changed) > 0) or (remaining <= 0):
+				return changed
+			time.sleep(min(self._poll_time, remaining))
+
+	def wait(self, timeout):
+		"""Waits for a change of any of the watched paths for at most the
+		given time. Returns the sorted list of changed paths once no further
+		change has happened for the debounce time, or an empty list if
+		nothing changed before the timeout."""
+		changed = self._wait_change(timeout)
+		if len(changed) == 0:
+			return [ ]
+		while True:
+			more_changes = self._wait_change(self._debounce_time)
+			if len(more_changes) == 0:
+				break
+			changed |= more_changes
+		if self.uses_inotify:
+			self._stat_snapshot = self._stat_all()
+		return sorted(changed)
+
+	def close(self):
+		if self._fd is not None:
+			os.close(self._fd)
+			self._fd = None
+
+if __name__ == "__main__":
+	watcher = FileWatcher(sys.argv[1:])
+	print("Watching %s using %s." % (", ".join(sys.argv[1:]), "inotify" if watcher.uses_inotify else "stat polling"))
+	while True:
+		changed = watcher.wait(60)
+		if len(changed) > 0:
+			print("Changed: %s" % (", ".join(changed)))
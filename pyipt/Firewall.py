@@ -19,8 +19,10 @@
 #
 #	Johannes Bauer <JohannesBauer@gmx.de>
 
+import os
 import json
 import sys
+import copy
 import datetime
 import enum
 from pyipt.Protocol import Protocol
@@ -35,6 +37,18 @@ from pyipt.Chain import Chain
 from pyipt.Exceptions import IncompatibleOptionsException, UnknownTypeError, FirewallRulesetException
 from pyipt.Criterion import Criterion
 from pyipt.Variables import Variables
+from pyipt.Resolver import Resolver
+from pyipt.RateLimit import RateLimit
+from pyipt.NFLog import NFLog
+from pyipt.Dispatcher import Dispatcher
+from pyipt.RulesetLoader import RulesetLoader
+from pyipt.Metrics import Metrics
+from pyipt.Feed import Feed, FeedReference
+from pyipt.DynamicSet import DynamicSet, SetReference
+from pyipt.FqdnSet import FqdnSet, FqdnReference
+from pyipt.TrafficControl import TrafficControl
+from pyipt.RuleTable import RuleTable
+from pyipt.Matches import InterfaceMatch, AddressMatch, SetMatch, ProtocolMatch, PortMatch, ICMPTypeMatch, StateMatch, StatisticMatch, U32Match, Comment, Verdict
 
 class RuleType(enum.Enum):
 	Accept = "accept"
@@ -43,6 +57,16 @@ class RuleType(enum.Enum):
 	Log = "log"
 	Masquerade = "masquerade"
 	PortForward = "port-forward"
+	NoTrack = "notrack"
+	FlowOffload = "flow-offload"
+	Mark = "mark"
+	Classify = "classify"
+	AcceptPortForwards = "accept-port-forwards"
+
+class BalanceMode(enum.Enum):
+	Nth = "nth"
+	Random = "random"
+	SourceHash = "source-hash"
 
 class HighlevelRule():
 	_SIMPLE_PARSE_CLASSES = {
@@ -56,6 +80,13 @@ class HighlevelRule():
 		"cond":				Condition,
 		"forward-to":		PortforwardTarget,
 		"msg":				str,
+		"limit":			RateLimit,
+		"nflog":			NFLog,
+		"balance":			BalanceMode,
+		"forward-accept":	bool,
+		"hw-offload":		bool,
+		"mark":				int,
+		"qos-class":		str,
 	}
 	_COMPLEX_PARSE_CLASSES = {
 		"dest-host":		Hostname,
@@ -66,6 +97,12 @@ class HighlevelRule():
 		"src-ifaddr":		InterfaceAddress,
 		"dest-if":			InterfaceName,
 		"src-if":			InterfaceName,
+		"dest-feed":		FeedReference,
+		"src-feed":			FeedReference,
+		"dest-set":			SetReference,
+		"src-set":			SetReference,
+		"dest-fqdn":		FqdnReference,
+		"src-fqdn":			FqdnReference,
 	}
 
 	def __init__(self, rule_src, config, variables):
@@ -86,6 +123,57 @@ class HighlevelRule():
 
 		self._sanity_check()
 
+	_LOG_PREFIX_LENGTH = 29
+	_NFLOG_PREFIX_LENGTH = 64
+	_CLASSIFY_CHAINS = set([ "POSTROUTING", "FORWARD", "OUTPUT" ])
+	_RAW_ACTIONS = set([ RuleType.Accept, RuleType.Drop, RuleType.Log, RuleType.NoTrack ])
+	# Port forwards with 'forward-accept' accept the translated connections
+	# in this chain. It is only entered from where the forward chain has an
+	# 'accept-port-forwards' rule, so that rules before it (e.g., bans)
+	# still apply and no catch-all rule can shadow it.
+	PORT_FORWARD_CHAIN = Chain("filter", "PORTFW")
+
+	_DNS_DEPENDENCIES = [ "src-host", "dest-host", "forward-to" ]
+
+	@classmethod
+	def dependencies(cls, rule_src, config, variables, metadata):
+		"""Returns all inputs a rule is compiled from: the rule source after
+		variable substitution, whether its condition is currently satisfied
+		and the current values of all hostnames and interfaces it refers to.
+		The compiled rule only changes when these change."""
+		rule_src = variables.recursive_replace(rule_src)
+		dependencies = [ json.dumps(rule_src, sort_keys = True) ]
+		if "cond" in rule_src:
+			satisfied = Condition(rule_src["cond"]).satisfied(metadata)
+			dependencies.append(satisfied)
+			if not satisfied:
+				return tuple(dependencies)
+		for (key, value) in sorted(rule_src.items()):
+			if key in cls._COMPLEX_PARSE_CLASSES:
+				dependencies.append((key, tuple(cls._COMPLEX_PARSE_CLASSES[key](value, config))))
+			elif key == "forward-to":
+				dependencies.append((key, tuple(Hostname(PortforwardTarget(value)["hostname"], config))))
+			elif key == "qos-class":
+				dependencies.append((key, metadata["qos"].classid(value)))
+		return tuple(dependencies)
+
+	@classmethod
+	def changed_inputs(cls, old_dependencies, new_dependencies):
+		"""Given the dependencies of the same rule source in two
+		generations, returns which kinds of inputs (time windows, DNS,
+		interfaces) differ between them."""
+		if old_dependencies == new_dependencies:
+			return set()
+		if [ value for value in old_dependencies if isinstance(value, bool) ] != [ value for value in new_dependencies if isinstance(value, bool) ]:
+			return set([ "timewindow" ])
+		old_values = dict(value for value in old_dependencies[1:] if isinstance(value, tuple))
+		new_values = dict(value for value in new_dependencies[1:] if isinstance(value, tuple))
+		changed = set()
+		for key in set(old_values) | set(new_values):
+			if old_values.get(key) != new_values.get(key):
+				changed.add("dns" if (key in cls._DNS_DEPENDENCIES) else "interface")
+		return changed
+
 	@property
 	def action(self):
 		return self._parsed["action"]
@@ -104,6 +192,18 @@ class HighlevelRule():
 			raise IncompatibleOptionsException("'service' and 'proto' are mutually exclusive in rule: %s" % (str(self._rule_src)))
 		if ("icmp-type" in self._parsed) and ("proto" in self._parsed):
 			raise IncompatibleOptionsException("'icmp-type' and 'proto' are mutually exclusive in rule: %s" % (str(self._rule_src)))
+		if ("nflog" in self._parsed) and (self.action != RuleType.Log):
+			raise IncompatibleOptionsException("'nflog' can only be used with the log action in rule: %s" % (str(self._rule_src)))
+		if (("balance" in self._parsed) or ("forward-accept" in self._parsed)) and (self.action != RuleType.PortForward):
+			raise IncompatibleOptionsException("'balance' and 'forward-accept' can only be used with port forwarding in rule: %s" % (str(self._rule_src)))
+		if ("hw-offload" in self._parsed) and (self.action != RuleType.FlowOffload):
+			raise IncompatibleOptionsException("'hw-offload' can only be used with the flow-offload action in rule: %s" % (str(self._rule_src)))
+		if (self.action == RuleType.FlowOffload) and ("criterion" in self._parsed):
+			raise IncompatibleOptionsException("flow offloading always applies to established connections and cannot have a criterion in rule: %s" % (str(self._rule_src)))
+		if ("mark" in self._parsed) != (self.action == RuleType.Mark):
+			raise IncompatibleOptionsException("the mark action requires 'mark', which cannot be used otherwise, in rule: %s" % (str(self._rule_src)))
+		if ("qos-class" in self._parsed) != (self.action == RuleType.Classify):
+			raise IncompatibleOptionsException("the classify action requires 'qos-class', which cannot be used otherwise, in rule: %s" % (str(self._rule_src)))
 		if self.action == RuleType.PortForward:
 			if "dest-ifaddr" not in self._parsed:
 				raise IncompatibleOptionsException("port forwarding requires 'dest-ifaddr' in rule: %s" % (str(self._rule_src)))
@@ -114,15 +214,116 @@ class HighlevelRule():
 			if (not self._parsed["forward-to"]["relative"]) and (self._parsed["forward-to"]["port"] is not None) and (any((portmap.span_count > 1) for (proto, portmap) in self._parsed["dest-service"])):
 				raise IncompatibleOptionsException("port forwarding requires relative port mapping when more than one span is defined in rule: %s" % (str(self._rule_src)))
 			hostname = Hostname(self._parsed["forward-to"]["hostname"], self._config)
-			if len(hostname) != 1:
-				raise IncompatibleOptionsException("port forwarding requires exactly one match for hostname, but found %d (%s) in rule: %s" % (len(hostname), ", ".join(hostname), str(self._rule_src)))
+			if "balance" in self._parsed:
+				if len(hostname) == 0:
+					raise IncompatibleOptionsException("load balanced port forwarding requires at least one match for hostname in rule: %s" % (str(self._rule_src)))
+			elif len(hostname) != 1:
+				raise IncompatibleOptionsException("port forwarding requires exactly one match for hostname unless 'balance' is given, but found %d (%s) in rule: %s" % (len(hostname), ", ".join(hostname), str(self._rule_src)))
+
+	def _protocols(self):
+		"""Returns the set of protocols this rule is restricted to or None if
+		it matches any protocol."""
+		if "proto" in self._parsed:
+			return set(self._parsed["proto"])
+		protocols = set()
+		for key in [ "src-service", "dest-service" ]:
+			if key in self._parsed:
+				protocols |= set(proto for (proto, port_map) in self._parsed[key])
+		if "icmp-type" in self._parsed:
+			protocols.add("icmp")
+		return protocols if (len(protocols) > 0) else None
+
+	def accepts_untracked(self, other):
+		"""Returns True if this rule accepts (at least part of) the traffic
+		matched by 'other' also when it is not tracked by conntrack. Only
+		protocols, services and ICMP types are compared, other restrictions
+		such as addresses are assumed to overlap."""
+		if self.action != RuleType.Accept:
+			return False
+		if ("criterion" in self._parsed) and (not self._parsed["criterion"].matches_untracked):
+			return False
+		protocols = self._protocols()
+		if (protocols is not None) and ((other._protocols() is None) or (not protocols >= other._protocols())):
+			return False
+		for key in [ "src-service", "dest-service" ]:
+			if key in self._parsed:
+				if (key not in other._parsed) or (not self._parsed[key].ports() >= other._parsed[key].ports()):
+					return False
+		if "icmp-type" in self._parsed:
+			if ("icmp-type" not in other._parsed) or (not set(self._parsed["icmp-type"]) >= set(other._parsed["icmp-type"])):
+				return False
+		return True
+
+	def _balance_match(self, index, count):
+		"""Returns the match that selects backend 'index' out of 'count' for a
+		load balanced port forwarding. Backends are tried in order, so every
+		match only sees what the previous ones did not take and the last
+		backend takes all remaining connections."""
+		if index == count - 1:
+			return ( )
+		if self._parsed["balance"] == BalanceMode.Nth:
+			return (StatisticMatch("nth", count - index), )
+		elif self._parsed["balance"] == BalanceMode.Random:
+			return (StatisticMatch("random", 1 / (count - index)), )
+		elif self._parsed["balance"] == BalanceMode.SourceHash:
+			# Distribute by the last octet of the source address (offset 12 in
+			# the IPv4 header) so that a client always reaches the same backend
+			return (U32Match("12&0xff=0x%x:0x%x" % (256 * index // count, (256 * (index + 1) // count) - 1)), )
+		else:
+			raise NotImplementedError(self._parsed["balance"])
+
+	def _forwarded_port(self, port):
+		"""Returns the port a single incoming port is forwarded to."""
+		forward_to = self._parsed["forward-to"]
+		if forward_to["relative"]:
+			return port + forward_to["port"]
+		else:
+			return forward_to["port"]
+
+	def _dnat_ports(self, begin_port, end_port):
+		"""Returns the port specification of the DNAT target for a span of
+		incoming ports. With a relative port mapping, a range is shifted as a
+		whole: port 'begin_port' maps to the first target port."""
+		if (begin_port == end_port) or (not self._parsed["forward-to"]["relative"]):
+			return str(self._forwarded_port(begin_port))
+		return "%d-%d/%d" % (self._forwarded_port(begin_port), self._forwarded_port(end_port), begin_port)
+
+	def _log_prefix(self, rule_id, max_length = None):
+		"""Returns the log prefix made of the rule ID and the message, each of
+		which may be absent. The message is shortened if the prefix would
+		exceed the maximum length."""
+		prefix = " ".join(part for part in [ rule_id, self._parsed.get("msg") ] if part is not None)
+		if prefix == "":
+			return None
+		if (max_length is not None) and (len(prefix) + 2 > max_length):
+			prefix = prefix[:max_length - 2]
+		return prefix + ": "
+
+	def insert(self, chain_name, ruleset, rule_id = None):
+		rules = self.compile(chain_name, ruleset.metadata, rule_id)
+		if rules is not None:
+			ruleset.add_rules(rules)
 
-	def insert(self, chain_name, ruleset):
+	def compile(self, chain_name, metadata, rule_id = None):
+		"""Returns the Rules implementing this rule in the given chain or None
+		if its condition is not satisfied. If a rule ID is given, it replaces
+		the comment in the kernel and prefixes log messages."""
+		comment = rule_id if (rule_id is not None) else self._parsed.get("comment")
 		if "cond" in self._parsed:
-			if not self._parsed["cond"].satisfied(ruleset.metadata):
-				return
+			if not self._parsed["cond"].satisfied(metadata):
+				return None
 
 		chain = Chain.parse(chain_name)
+		if (self.action == RuleType.NoTrack) and (chain.table != "raw"):
+			raise IncompatibleOptionsException("'notrack' can only be used in the raw table, not in %s: %s" % (str(chain), str(self._rule_src)))
+		if (self.action in (RuleType.FlowOffload, RuleType.AcceptPortForwards)) and ((chain.table != "filter") or (chain.chain.upper() != "FORWARD")):
+			raise IncompatibleOptionsException("'%s' can only be used in the forward chain, not in %s: %s" % (self.action.value, str(chain), str(self._rule_src)))
+		if (self.action in (RuleType.Mark, RuleType.Classify)) and (chain.table != "mangle"):
+			raise IncompatibleOptionsException("'%s' can only be used in the mangle table, not in %s: %s" % (self.action.value, str(chain), str(self._rule_src)))
+		if (self.action == RuleType.Classify) and (chain.chain.upper() not in self._CLASSIFY_CHAINS):
+			raise IncompatibleOptionsException("'classify' can only be used in the mangle chains %s, not in %s: %s" % (", ".join(sorted(self._CLASSIFY_CHAINS)), str(chain), str(self._rule_src)))
+		if (chain.table == "raw") and (self.action not in self._RAW_ACTIONS):
+			raise IncompatibleOptionsException("action '%s' cannot be used in the raw table (only %s): %s" % (self.action.value, ", ".join(sorted(action.value for action in self._RAW_ACTIONS)), str(self._rule_src)))
 
 		rules = Rules(self.comment)
 		rule = rules.new()
@@ -131,117 +332,231 @@ class HighlevelRule():
 		if "proto" in self._parsed:
 			group = rule.add_group("proto")
 			for proto in self._parsed["proto"]:
-				group.append([ "-p", proto ])
+				group.append((ProtocolMatch(proto), ))
 
 		if "icmp-type" in self._parsed:
 			group = rule.add_group("icmp-type")
 			for icmp_type in self._parsed["icmp-type"]:
-				group.append([ "-p", "icmp", "--icmp-type", icmp_type ])
+				group.append((ICMPTypeMatch(icmp_type), ))
 
 		for srcdest in [ "src", "dest" ]:
+			direction = {
+				"src":	"src",
+				"dest":	"dst",
+			}[srcdest]
 			if srcdest + "-if" in self._parsed:
-				option = {
-					"src":	"-i",
-					"dest":	"-o",
+				interface_direction = {
+					"src":	"in",
+					"dest":	"out",
 				}[srcdest]
 				group = rule.add_group(srcdest + "-if")
-				for ifname in self._parsed[srcdest + "-if"]:
-					group.append([ option, ifname ])
+				for (ifname, negated) in self._parsed[srcdest + "-if"]:
+					group.append((InterfaceMatch(interface_direction, ifname, negated), ))
 			if srcdest + "-net" in self._parsed:
-				option = {
-					"src":	"-s",
-					"dest":	"-d",
-				}[srcdest]
 				group = rule.add_group(srcdest + "-net")
 				for network in self._parsed[srcdest + "-net"]:
-					group.append([ option, network ])
+					group.append((AddressMatch(direction, network), ))
 			if srcdest + "-service" in self._parsed:
 				group = rule.add_group(srcdest + "-service")
 				if (srcdest == "dest") and self._parsed["action"] == RuleType.PortForward:
-					# For port forwarding/DNAT target, the syntax is different
-					def dnat_target(incoming_port, forward_to):
-						hostname = Hostname(forward_to["hostname"], self._config)
-						result = [ "-j", "DNAT", "--to" ]
-						if len(hostname) == 0:
-							print("Warning: For DNAT/port forwarding, a target is required, but %s could not be resolved successfully." % (forward_to["hostname"]))
-						elif len(hostname) != 1:
+					# For port forwarding/DNAT target, the syntax is different.
+					# The target is resolved only once for the whole rule.
+					forward_to = self._parsed["forward-to"]
+					hostname = Hostname(forward_to["hostname"], self._config)
+					if len(hostname) == 0:
+						print("Warning: For DNAT/port forwarding, a target is required, but %s could not be resolved successfully." % (forward_to["hostname"]))
+						backends = [ ]
+					elif "balance" in self._parsed:
+						backends = list(hostname)
+					else:
+						if len(hostname) != 1:
 							print("Warning: For DNAT/port forwarding, a single target is required, but %d were found. Arbitrarily picking the first one." % (len(hostname)))
-						if forward_to["port"] is None:
-							result.append(hostname[0])
+						backends = [ hostname[0] ]
+
+					def dnat_target(backend, ports):
+						if ports is None:
+							return Verdict("DNAT", ( "--to", backend ))
 						else:
-							if forward_to["relative"]:
-								result.append("%s:%d" % (hostname[0], incoming_port + forward_to["port"]))
-							else:
-								result.append("%s:%d" % (hostname[0], forward_to["port"]))
-						return result
+							return Verdict("DNAT", ( "--to", "%s:%s" % (backend, ports) ))
 
+					forward_accepts = [ ]
 					for (proto, port_map) in self._parsed[srcdest + "-service"]:
-						for single_port in port_map.single:
-							group.append([ "-p", proto, "--dport", str(single_port) ] + dnat_target(single_port, self._parsed["forward-to"]))
-						for (begin_range, end_range) in port_map.ranges:
-							group.append([ "-p", proto, "--dport", "%d:%d" % (begin_range, end_range) ] + dnat_target(begin_range, self._parsed["forward-to"]))
+						spans = [ (port, port) for port in sorted(port_map.single) ] + port_map.ranges
+						for (begin_port, end_port) in spans:
+							if forward_to["port"] is None:
+								ports = None
+							else:
+								ports = self._dnat_ports(begin_port, end_port)
+							port_match = PortMatch("dst", proto, [ (begin_port, end_port) ])
+							for (index, backend) in enumerate(backends):
+								group.append((port_match, ) + self._balance_match(index, len(backends)) + (dnat_target(backend, ports), ))
+								forward_accepts.append((ProtocolMatch(proto), AddressMatch("dst", backend), StateMatch([ "DNAT" ], module = "conntrack", orig_dport = (begin_port, end_port))))
+
+					if self._parsed.get("forward-accept", False):
+						# Accept the translated connections in the filter table
+						forward_rule = rules.new()
+						forward_rule.add_fixed(self.PORT_FORWARD_CHAIN.iptables_append())
+						forward_rule.add_group("forward-accept", forward_accepts)
+						forward_rule.add_fixed((Verdict("ACCEPT"), ))
+						if comment is not None:
+							forward_rule.add_fixed((Comment(comment), ))
 				else:
 					# Not port forwarding (simple ACCEPT/REJCECT/etc.)
-					option = {
-						"src":	"s",
-						"dest":	"d",
-					}[srcdest]
 					for (proto, port_map) in self._parsed[srcdest + "-service"]:
 						if port_map.port_count == 1:
-							group.append([ "-p", proto, "--%sport" % (option), str(port_map[0]) ])
+							group.append((PortMatch(direction, proto, [ (port_map[0], port_map[0]) ]), ))
 						else:
 							if len(port_map.single) > 1:
-								group.append([ "-p", proto, "--match", "multiport", "--%sports" % (option), ",".join(str(port) for port in port_map.single) ])
+								group.append((PortMatch(direction, proto, [ (port, port) for port in port_map.single ], multiport = True), ))
 							for (begin_range, end_range) in port_map.ranges:
-								group.append([ "-p", proto, "--match", "multiport", "--%sports" % (option), "%d:%d" % (begin_range, end_range) ])
+								group.append((PortMatch(direction, proto, [ (begin_range, end_range) ], multiport = True), ))
 			if srcdest + "-ifaddr" in self._parsed:
-				option = {
-					"src":	"-s",
-					"dest":	"-d",
-				}[srcdest]
 				group = rule.add_group(srcdest + "-ifaddr")
 				for address in self._parsed[srcdest + "-ifaddr"]:
-					group.append([ option, address ])
+					group.append((AddressMatch(direction, address), ))
+			if srcdest + "-feed" in self._parsed:
+				group = rule.add_group(srcdest + "-feed")
+				for set_name in self._parsed[srcdest + "-feed"]:
+					group.append((SetMatch(direction, set_name), ))
+			if srcdest + "-set" in self._parsed:
+				group = rule.add_group(srcdest + "-set")
+				for set_name in self._parsed[srcdest + "-set"]:
+					group.append((SetMatch(direction, set_name), ))
+			if srcdest + "-fqdn" in self._parsed:
+				group = rule.add_group(srcdest + "-fqdn")
+				for set_name in self._parsed[srcdest + "-fqdn"]:
+					group.append((SetMatch(direction, set_name), ))
 			if srcdest + "-host" in self._parsed:
-				option = {
-					"src":	"-s",
-					"dest":	"-d",
-				}[srcdest]
 				group = rule.add_group(srcdest + "-host")
 				for address in self._parsed[srcdest + "-host"]:
-					group.append([ option, address ])
+					group.append((AddressMatch(direction, address), ))
 
 		if "criterion" in self._parsed:
 			self._parsed["criterion"].apply(rule)
+		elif self._parsed["action"] == RuleType.FlowOffload:
+			# Only flows that conntrack has seen in both directions can be
+			# offloaded, the first packets always traverse the whole ruleset
+			rule.add_fixed((StateMatch([ "RELATED", "ESTABLISHED" ], module = "conntrack"), ))
+
+		if "limit" in self._parsed:
+			rule.add_fixed((self._parsed["limit"].match(), ))
 
-		if self._parsed["action"] in (RuleType.Accept, RuleType.Reject, RuleType.Drop, RuleType.Masquerade, RuleType.Log):
-			rule.add_fixed(("-j", self._parsed["action"].value.upper()))
+		if self._parsed["action"] in (RuleType.Accept, RuleType.Reject, RuleType.Drop, RuleType.Masquerade):
+			rule.add_fixed((Verdict(self._parsed["action"].value.upper()), ))
+		elif self._parsed["action"] == RuleType.Log:
+			if "nflog" in self._parsed:
+				prefix = self._log_prefix(rule_id, max_length = self._NFLOG_PREFIX_LENGTH)
+				rule.add_fixed((self._parsed["nflog"].verdict(None if (prefix is None) else prefix[:-2]), ))
+			elif self._log_prefix(rule_id) is not None:
+				rule.add_fixed((Verdict("LOG", ( "--log-prefix", self._log_prefix(rule_id, max_length = self._LOG_PREFIX_LENGTH) )), ))
+			else:
+				rule.add_fixed((Verdict("LOG"), ))
 		elif self._parsed["action"] == RuleType.PortForward:
 			# We're in nat.PREROUTING
 			pass
+		elif self._parsed["action"] == RuleType.NoTrack:
+			rule.add_fixed((Verdict("CT", ( "--notrack", )), ))
+		elif self._parsed["action"] == RuleType.AcceptPortForwards:
+			rule.add_fixed((Verdict(self.PORT_FORWARD_CHAIN.chain), ))
+		elif self._parsed["action"] == RuleType.Mark:
+			rule.add_fixed((Verdict("MARK", ( "--set-mark", "0x%x" % (self._parsed["mark"]) )), ))
+		elif self._parsed["action"] == RuleType.Classify:
+			rule.add_fixed((Verdict("CLASSIFY", ( "--set-class", metadata["qos"].classid(self._parsed["qos-class"]) )), ))
+		elif self._parsed["action"] == RuleType.FlowOffload:
+			# FLOWOFFLOAD does not terminate rule traversal, packets of flows
+			# not yet offloaded are still accepted by the following rules
+			rule.add_fixed((Verdict("FLOWOFFLOAD", ( "--hw", ) if self._parsed.get("hw-offload") else ( )), ))
 		else:
 			raise NotImplementedError(self._parsed["action"])
 
-		if self._parsed["action"] == RuleType.Log:
-			if "msg" in self._parsed:
-				rule.add_fixed(("--log-prefix", self._parsed["msg"] + ": "))
+		if comment is not None:
+			rule.add_fixed((Comment(comment), ))
 
-		if "comment" in self._parsed:
-			rule.add_fixed(("-m", "comment", "--comment", self._parsed["comment"]))
-
-		ruleset.add_rules(rules)
+		return rules
 
 class Firewall():
+	_STATIC_INPUT_PATHS = [ "/etc/services", "/etc/hosts" ]
+	# Everything a generation replaces; taken over from a precomputed
+	# generation once its ruleset is applied
+	_GENERATION_STATE = [ "_loader", "_input_paths", "_rule_cache", "_rule_dependencies", "_feeds", "_dynamic_sets", "_fqdn_sets", "_changed_inputs", "_services_mtime", "_conditions" ]
+	_UNTRACKED_PATHS = {
+		"PREROUTING":	[ "INPUT", "FORWARD" ],
+		"OUTPUT":		[ "OUTPUT" ],
+	}
+
 	def __init__(self, ruleset_filename, args):
 		self._ruleset_filename = ruleset_filename
 		self._args = args
+		self._loader = RulesetLoader(self._ruleset_filename)
+		self._input_paths = [ self._ruleset_filename ] + self._STATIC_INPUT_PATHS
+		self._rule_cache = { }
+		self._rule_dependencies = { }
+		self._feeds = { }
+		self._dynamic_sets = [ ]
+		self._fqdn_sets = [ ]
+		self._changed_inputs = set()
+		self._services_mtime = None
+		self._precomputed = None
+		self._conditions = [ ]
+		self._metrics = Metrics()
+		if self._args.state_dir is not None:
+			self._resolver = Resolver(self._args.state_dir + "/dns_snapshot.json", metrics = self._metrics)
+		else:
+			self._resolver = Resolver(metrics = self._metrics)
+
+	@property
+	def resolver(self):
+		return self._resolver
 
-	def _parse_chain(self, ruleset, chain_name, content):
+	@property
+	def feeds(self):
+		return list(self._feeds.values())
+
+	@property
+	def dynamic_sets(self):
+		return self._dynamic_sets
+
+	@property
+	def fqdn_sets(self):
+		return self._fqdn_sets
+
+	@property
+	def metrics(self):
+		return self._metrics
+
+	@property
+	def changed_inputs(self):
+		"""Kinds of inputs that changed between the last two generated
+		rulesets (e.g., 'ruleset', 'dns', 'interface' or 'timewindow')."""
+		return sorted(self._changed_inputs)
+
+	@property
+	def input_paths(self):
+		"""Files and directories the last generated ruleset was created
+		from. A change to any of them requires regeneration."""
+		return self._input_paths
+
+	def _parse_chain(self, ruleset, chain_name, content, rule_cache, rule_dependencies):
 		if "rules" in content:
-			for rulesrc in content["rules"]:
+			origins = self._loader.rule_origins.get(chain_name, [ ])
+			for (index, rulesrc) in enumerate(content["rules"]):
 				try:
-					hl_rule = HighlevelRule(rulesrc, ruleset.metadata["source"], ruleset.metadata["variables"])
-					hl_rule.insert(chain_name, ruleset)
+					origin = origins[index] if (index < len(origins)) else (self._ruleset_filename, index)
+					comment = ruleset.metadata["variables"].recursive_replace(rulesrc).get("comment")
+					rule_id = ruleset.metadata["rule_table"].assign(chain_name, rulesrc, origin, comment)
+					# Compiled rules are reused from the previous generation if
+					# none of their dependencies changed
+					dependencies = HighlevelRule.dependencies(rulesrc, ruleset.metadata["source"], ruleset.metadata["variables"], ruleset.metadata)
+					rule_dependencies[(chain_name, index)] = dependencies
+					key = (chain_name, rule_id, dependencies)
+					if key in self._rule_cache:
+						rules = self._rule_cache[key]
+					else:
+						hl_rule = HighlevelRule(rulesrc, ruleset.metadata["source"], ruleset.metadata["variables"])
+						rules = hl_rule.compile(chain_name, ruleset.metadata, rule_id)
+					rule_cache[key] = rules
+					if rules is not None:
+						ruleset.add_rules(rules)
 				except FirewallRulesetException as e:
 					if not self._args.ignore_errors:
 						raise
@@ -259,23 +574,215 @@ class Firewall():
 
 			rule = rules.new()
 			rule.add_fixed(chain.iptables_flush())
+
+		# The chain for accepting port forwards is created (or flushed) before
+		# anything is added to it or jumps to it
+		rulesrcs = [ ruleset.metadata["variables"].recursive_replace(rulesrc) for content in ruleset.metadata["source"]["chains"].values() for rulesrc in content.get("rules", [ ]) ]
+		actions = set(rulesrc.get("action") for rulesrc in rulesrcs)
+		if any(rulesrc.get("forward-accept") for rulesrc in rulesrcs) or (RuleType.AcceptPortForwards.value in actions):
+			rule = rules.new()
+			rule.add_fixed(HighlevelRule.PORT_FORWARD_CHAIN.command("-N"))
+			if self._loader.changed and (RuleType.AcceptPortForwards.value not in actions):
+				print("Warning: Port forwards use 'forward-accept', but no rule of the forward chain has the action '%s', so their connections are not accepted." % (RuleType.AcceptPortForwards.value), file = sys.stderr)
 		ruleset.add_rules(rules)
 
 	def _parse_ruleset(self, ruleset):
-		self._initialize_chains(ruleset)
-		for (chain_name, content) in ruleset.metadata["source"]["chains"].items():
-			self._parse_chain(ruleset, chain_name, content)
+		# Services are read from /etc/services while compiling, so when it
+		# changes no previously compiled rule can be reused
+		self._changed_inputs = set()
+		services_mtime = os.stat("/etc/services").st_mtime_ns
+		if services_mtime != self._services_mtime:
+			self._rule_cache = { }
+			self._services_mtime = services_mtime
+			self._changed_inputs.add("services")
+
+		with self._metrics.time("firewalld_generation_phase_seconds", phase = "compile"):
+			self._initialize_chains(ruleset)
+			rule_cache = { }
+			rule_dependencies = { }
+			for (chain_name, content) in ruleset.metadata["source"]["chains"].items():
+				self._parse_chain(ruleset, chain_name, content, rule_cache, rule_dependencies)
+			self._rule_cache = rule_cache
+
+		if self._loader.changed:
+			self._changed_inputs.add("ruleset")
+		else:
+			# Same rule sources as before, find out which of their dynamic
+			# dependencies changed
+			for (key, dependencies) in rule_dependencies.items():
+				if key in self._rule_dependencies:
+					self._changed_inputs |= HighlevelRule.changed_inputs(self._rule_dependencies[key], dependencies)
+		self._rule_dependencies = rule_dependencies
+
+		with self._metrics.time("firewalld_generation_phase_seconds", phase = "dispatch"):
+			for (chain_name, content) in ruleset.metadata["source"]["chains"].items():
+				if "dispatch" in content:
+					Dispatcher(Chain.parse(chain_name), content["dispatch"]).apply(ruleset)
+
+	def _check_untracked(self, ruleset):
+		"""Warns about notrack rules whose traffic is dropped by all filter
+		chains it can traverse afterwards. Untracked packets never match rules
+		that rely on connection tracking (e.g., established/related), so they
+		need to be accepted explicitly."""
+		source = ruleset.metadata["source"]
+		variables = ruleset.metadata["variables"]
+		parsed_chains = { }
+		for (chain_name, content) in source["chains"].items():
+			chain = Chain.parse(chain_name)
+			hl_rules = [ ]
+			for rulesrc in content.get("rules", [ ]):
+				try:
+					hl_rules.append(HighlevelRule(rulesrc, source, variables))
+				except FirewallRulesetException:
+					# Already reported while compiling
+					pass
+			parsed_chains[(chain.table, chain.chain.upper())] = (content.get("default", "accept").lower() == "accept", hl_rules)
+
+		for ((table, raw_chain), (raw_default_accept, raw_rules)) in parsed_chains.items():
+			if table != "raw":
+				continue
+			filter_chains = self._UNTRACKED_PATHS.get(raw_chain, [ ])
+			for notrack_rule in raw_rules:
+				if notrack_rule.action != RuleType.NoTrack:
+					continue
+				for filter_chain in filter_chains:
+					(default_accept, hl_rules) = parsed_chains.get(("filter", filter_chain), (True, [ ]))
+					if default_accept or any(hl_rule.accepts_untracked(notrack_rule) for hl_rule in hl_rules):
+						break
+				else:
+					print("Warning: Traffic exempted from connection tracking in raw.%s is not accepted by any rule of %s that also matches untracked packets: %s" % (raw_chain, " or ".join(filter_chains), notrack_rule.comment), file = sys.stderr)
+
+	def _update_metrics(self, ruleset):
+		self._metrics.inc("firewalld_generations_total")
+		self._metrics.clear("firewalld_rules")
+		for (chain, commands) in ruleset.generate_by_chain().items():
+			rule_count = sum(1 for command in commands if Ruleset.split_table(command)[1][0] == "-A")
+			self._metrics.set("firewalld_rules", rule_count, chain = chain)
+
+	def _update_conditions(self, source, variables):
+		self._conditions = [ ]
+		for content in source["chains"].values():
+			for rulesrc in content.get("rules", [ ]):
+				rulesrc = variables.recursive_replace(rulesrc)
+				if "cond" in rulesrc:
+					try:
+						self._conditions.append(Condition(rulesrc["cond"]))
+					except FirewallRulesetException:
+						# Already reported while compiling
+						pass
+
+	def transitions(self, start, end):
+		"""Returns all points in time after start and up to end (sorted) at
+		which the condition of at least one rule of the last generated
+		ruleset changes, i.e., at which the ruleset needs to be generated
+		anew."""
+		boundaries = set()
+		for condition in self._conditions:
+			boundaries |= condition.boundaries()
+		if len(boundaries) == 0:
+			return [ ]
+		week_start = datetime.datetime.combine(start.date() - datetime.timedelta(days = start.weekday()), datetime.time())
+		one_second = datetime.timedelta(seconds = 1)
+		transitions = [ ]
+		week = 0
+		while week_start + datetime.timedelta(weeks = week) <= end:
+			for second in sorted(boundaries):
+				timestamp = week_start + datetime.timedelta(weeks = week, seconds = second)
+				if (timestamp <= start) or (timestamp > end):
+					continue
+				if any(condition.satisfied({ "now": timestamp - one_second }) != condition.satisfied({ "now": timestamp }) for condition in self._conditions):
+					transitions.append(timestamp)
+			week += 1
+		return transitions
+
+	def _update_fqdn_sets(self, source):
+		fqdns = FqdnSet.collect(source)
+		if len(fqdns) == 0:
+			self._fqdn_sets = [ ]
+			return
+		options = FqdnSet.snoop_options(source)
+		self._fqdn_sets = [ FqdnSet(fqdn, options["max_ttl"]) for fqdn in fqdns ]
+		if self._loader.changed:
+			# Without DNS responses being logged to the group, the sets stay empty
+			nflog_groups = set(rulesrc.get("nflog", { }).get("group", 0) for content in source["chains"].values() for rulesrc in content.get("rules", [ ]) if isinstance(rulesrc.get("nflog"), dict))
+			if options["group"] not in nflog_groups:
+				print("Warning: Rules refer to domain names, but no rule logs DNS responses to NFLOG group %d." % (options["group"]), file = sys.stderr)
+
+	def _update_feeds(self, source):
+		# Feeds are kept across generations so that their files are only read
+		# again when they change
+		feeds = { }
+		for (name, definition) in source.get("feeds", { }).items():
+			if (name in self._feeds) and (self._feeds[name].filename == definition.get("file")):
+				feeds[name] = self._feeds[name]
+			else:
+				feeds[name] = Feed(name, definition)
+		self._feeds = feeds
+
+	def generate(self, now = None, precompute = False):
+		"""Generates the ruleset. When a point in time is given, time windows
+		are evaluated for that time instead of the current one, e.g., to
+		prepare the ruleset of an upcoming transition. Hostnames are then
+		resolved with the answers of the previous generation.
+
+		A precomputed ruleset is generated on a copy of the generation state
+		(loaded sources, rule cache, changed inputs, ...), so the state and
+		the metrics of the current ruleset stay untouched until it is passed
+		to adopt_precomputed() when it actually replaces the current one."""
+		if precompute:
+			firewall = copy.copy(self)
+			firewall._loader = copy.copy(self._loader)
+			ruleset = firewall._generate(now, update_metrics = False)
+			self._precomputed = (ruleset, firewall)
+			return ruleset
+		self._precomputed = None
+		return self._generate(now)
+
+	def adopt_precomputed(self, ruleset):
+		"""Makes a ruleset previously generated with precompute set the
+		current one, i.e., takes over its generation state and metrics."""
+		assert (self._precomputed is not None) and (self._precomputed[0] is ruleset)
+		firewall = self._precomputed[1]
+		for attribute in self._GENERATION_STATE:
+			setattr(self, attribute, getattr(firewall, attribute))
+		self._update_metrics(ruleset)
+		self._precomputed = None
 
-	def generate(self):
-		with open(self._ruleset_filename) as f:
-			source = json.load(f)
+	def _generate(self, now, update_metrics = True):
+		with self._metrics.time("firewalld_generation_phase_seconds", phase = "load"):
+			source = self._loader.load()
+			self._update_feeds(source)
+			self._dynamic_sets = [ DynamicSet(name, definition) for (name, definition) in source.get("sets", { }).items() ]
+			self._update_fqdn_sets(source)
 		source["interfaces-rev"] = { value: key for (key, value) in source["interfaces"].items() }
+		source["resolver"] = self._resolver
+		source["metrics"] = self._metrics
+		source["ifaddr-cache"] = { }
+		if now is None:
+			now = datetime.datetime.now()
+			self._resolver.new_generation()
 		metadata = {
-			"now":			datetime.datetime.now(),
+			"now":			now,
 			"source":		source,
 			"variables":	Variables(source.get("variables", { })),
+			"ruleset_files":	list(self._loader.filenames),
+			"feeds":		self.feeds,
+			"dynamic_sets":	self.dynamic_sets,
+			"fqdn_sets":	self.fqdn_sets,
+			"rule_table":	RuleTable(),
+			"qos":			TrafficControl(source.get("qos", { }), source),
 		}
 		ruleset = Ruleset(metadata)
-		ruleset.add_stat("ruleset_mtime", self._ruleset_filename)
+		for filename in self._loader.filenames:
+			ruleset.add_stat("ruleset_mtime", filename)
+		self._input_paths = self._loader.filenames + self._STATIC_INPUT_PATHS + [ feed.filename for feed in self.feeds ]
+		if "mock_interfaces" in source.get("options", { }):
+			self._input_paths.append(source["options"]["mock_interfaces"])
 		self._parse_ruleset(ruleset)
+		self._update_conditions(source, metadata["variables"])
+		if self._loader.changed and any(Chain.parse(chain_name).table == "raw" for chain_name in source["chains"]):
+			self._check_untracked(ruleset)
+		self._resolver.save()
+		if update_metrics:
+			self._update_metrics(ruleset)
 		return ruleset
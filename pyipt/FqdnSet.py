@@ -0,0 +1,134 @@
+#	firewalld - Linux firewall daemon with time-based capabilities
+#	Copyright (C) 2020-2021 Johannes Bauer
+#
+#	This file is part of firewalld.
+#
+#	firewalld is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	firewalld is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with firewalld; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import re
+from pyipt.IPSet import IPSet, IPSetReference
+from pyipt.Tools import multisplit
+from pyipt.Variables import Variables
+from pyipt.Exceptions import InvalidFqdnException
+
+class FqdnSet():
+	"""Holds the addresses a fully qualified domain name (or a wildcard such
+	as '*.redd.it', which matches all subdomains) currently resolves to. The
+	set is filled at runtime from snooped DNS responses and every address
+	expires in the kernel once the TTL of its answer is over. Rules that
+	refer to the name therefore follow rotating addresses without the
+	ruleset ever being regenerated. Like dynamic sets, the set is only ever
+	created and never flushed."""
+	_SET_PREFIX = "fwdns_"
+	_FQDN_RE = re.compile(r"(\*\.)?([a-z0-9_]([-a-z0-9_]*[a-z0-9_])?\.)*[a-z0-9_]([-a-z0-9_]*[a-z0-9_])?")
+	_RULE_KEYS = [ "src-fqdn", "dest-fqdn" ]
+	_SNOOP_DEFAULTS = {
+		"min_ttl":	300,
+		"max_ttl":	86400,
+	}
+
+	def __init__(self, fqdn, max_ttl):
+		self._fqdn = self.normalize(fqdn)
+		self._ipset = IPSet(self.set_name(self._fqdn), timeout = max_ttl)
+
+	@classmethod
+	def normalize(cls, fqdn):
+		fqdn = fqdn.lower().rstrip(".")
+		if cls._FQDN_RE.fullmatch(fqdn) is None:
+			raise InvalidFqdnException("Not a valid domain name or wildcard: %s" % (fqdn))
+		return fqdn
+
+	@classmethod
+	def set_name(cls, fqdn):
+		return IPSet.derived_name(cls._SET_PREFIX, fqdn)
+
+	@classmethod
+	def snoop_options(cls, config):
+		"""Returns the validated 'dns_snoop' options: the NFLOG group DNS
+		responses are logged to and the bounds the TTL of an answer is
+		clamped to. Every rule that logs to the group must be limited to the
+		trusted resolver with 'src-host', since the addresses of all responses
+		logged to it end up in sets that rules rely on."""
+		options = config.get("options", { }).get("dns_snoop")
+		if not isinstance(options, dict):
+			raise InvalidFqdnException("Domain name matches require the 'dns_snoop' option with the NFLOG group of DNS responses.")
+		unknown_keys = set(options) - set([ "group" ]) - set(cls._SNOOP_DEFAULTS)
+		if len(unknown_keys) > 0:
+			raise InvalidFqdnException("Unknown dns_snoop option(s): %s" % (", ".join(sorted(unknown_keys))))
+		options = dict(cls._SNOOP_DEFAULTS, **options)
+		for (key, value) in options.items():
+			if (not isinstance(value, int)) or (value < 0):
+				raise InvalidFqdnException("dns_snoop option '%s' must be a non-negative integer: %s" % (key, str(value)))
+		if "group" not in options:
+			raise InvalidFqdnException("dns_snoop option requires the NFLOG 'group'.")
+		if options["min_ttl"] > options["max_ttl"]:
+			raise InvalidFqdnException("dns_snoop option 'min_ttl' exceeds 'max_ttl'.")
+		variables = Variables(config.get("variables", { }))
+		for content in config["chains"].values():
+			for rulesrc in content.get("rules", [ ]):
+				rulesrc = variables.recursive_replace(rulesrc)
+				if isinstance(rulesrc.get("nflog"), dict) and (rulesrc["nflog"].get("group", 0) == options["group"]) and ("src-host" not in rulesrc):
+					raise InvalidFqdnException("Rule logging to the dns_snoop NFLOG group %d must be limited to the trusted resolver with 'src-host': %s" % (options["group"], str(rulesrc)))
+		return options
+
+	@classmethod
+	def collect(cls, config):
+		"""Returns all domain names the rules of a ruleset refer to."""
+		variables = Variables(config.get("variables", { }))
+		fqdns = set()
+		for content in config["chains"].values():
+			for rulesrc in content.get("rules", [ ]):
+				for key in cls._RULE_KEYS:
+					if key in rulesrc:
+						fqdns |= set(cls.normalize(fqdn) for fqdn in multisplit(variables.recursive_replace(rulesrc[key])))
+		return sorted(fqdns)
+
+	@property
+	def fqdn(self):
+		return self._fqdn
+
+	@property
+	def name(self):
+		return self._fqdn
+
+	@property
+	def ipset(self):
+		return self._ipset
+
+	def matches(self, name):
+		if self._fqdn.startswith("*."):
+			return name.endswith(self._fqdn[1:])
+		return name == self._fqdn
+
+	def ensure(self):
+		self._ipset.create()
+
+	def add(self, address, timeout):
+		self._ipset.add(address, timeout = timeout)
+
+	def script_commands(self):
+		yield " ".join(self._ipset.create_command())
+
+class FqdnReference(IPSetReference):
+	"""Refers to the sets of one or more domain names from within a rule."""
+	def __init__(self, fqdn_str, config):
+		FqdnSet.snoop_options(config)
+		super().__init__(fqdn_str, config)
+
+	@classmethod
+	def _set_name(cls, fqdn, config):
+		return FqdnSet.set_name(FqdnSet.normalize(fqdn))
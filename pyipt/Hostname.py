@@ -19,9 +19,8 @@
 #
 #	Johannes Bauer <JohannesBauer@gmx.de>
 
-import sys
-import socket
 from pyipt.Tools import multisplit
+from pyipt.Resolver import Resolver
 
 class Hostname():
 	def __init__(self, hostname_str, config):
@@ -32,12 +31,9 @@ class Hostname():
 			else:
 				self._addresses.add(config["hosts"][hostname_str])
 		else:
+			resolver = config.get("resolver") or Resolver()
 			for hostname in multisplit(hostname_str):
-				try:
-					(name, aliaslist, addresslist) = socket.gethostbyname_ex(hostname)
-					self._addresses |= set(addresslist)
-				except socket.gaierror as e:
-					print("Warning: Unable to resolve hostname %s: %s" % (hostname, str(e)), file = sys.stderr)
+				self._addresses |= set(resolver.resolve(hostname))
 		self._addresses = sorted(self._addresses)
 
 	def __getitem__(self, index):
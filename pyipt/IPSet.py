@@ -0,0 +1,198 @@
+#	firewalld - Linux firewall daemon with time-based capabilities
+#	Copyright (C) 2020-2021 Johannes Bauer
+#
+#	This file is part of firewalld.
+#
+#	firewalld is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	firewalld is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with firewalld; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import sys
+import hashlib
+import subprocess
+from pyipt.Tools import multisplit
+
+class IPSet():
+	"""Manages the members of a kernel ipset. Changes are loaded in a single
+	batch through 'ipset restore'. Small changes are applied as add/del
+	diffs to the live set. A complete reload fills a temporary set which is
+	then atomically swapped with the live one, so that the set is never
+	observed partially populated; iptables rules which reference the set
+	by name are never touched."""
+	_MAX_NAME_LENGTH = 31
+	_TMP_SUFFIX = "_new"
+
+	def __init__(self, name, set_type = "hash:net", timeout = None):
+		assert(len(name) <= self._MAX_NAME_LENGTH - len(self._TMP_SUFFIX))
+		self._name = name
+		self._set_type = set_type
+		self._timeout = timeout
+
+	@classmethod
+	def derived_name(cls, prefix, name):
+		"""Returns the name of the set for an object (e.g., a feed) of the
+		given name. Names that are too long, leaving room for the suffix of
+		the temporary set, are replaced by their hash."""
+		set_name = prefix + name.replace("*", "_")
+		max_length = cls._MAX_NAME_LENGTH - len(cls._TMP_SUFFIX)
+		if len(set_name) > max_length:
+			set_name = prefix + hashlib.md5(name.encode("utf-8")).hexdigest()[:max_length - len(prefix)]
+		return set_name
+
+	@property
+	def name(self):
+		return self._name
+
+	def create_options(self, member_count):
+		maxelem = max(65536, 2 * member_count)
+		hashsize = 1024
+		while hashsize < member_count:
+			hashsize *= 2
+		options = [ "hashsize", str(hashsize), "maxelem", str(maxelem) ]
+		if self._timeout is not None:
+			# Entries expire in the kernel, a timeout of 0 means that entries
+			# are permanent unless they are added with their own timeout
+			options += [ "timeout", str(self._timeout) ]
+		return options
+
+	def exists(self):
+		return subprocess.call([ "ipset", "list", "-name", self._name ], stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL) == 0
+
+	def entries(self):
+		"""Returns a dictionary of all members and their remaining timeout
+		in seconds (None if they do not expire)."""
+		output = subprocess.check_output([ "ipset", "save", self._name ]).decode("ascii")
+		entries = { }
+		for line in output.split("\n"):
+			fields = line.split()
+			if (len(fields) >= 3) and (fields[0] == "add"):
+				# Single addresses are listed without prefix length
+				member = fields[2] if ("/" in fields[2]) else (fields[2] + "/32")
+				timeout = None
+				if ("timeout" in fields[3:]) and (fields.index("timeout") + 1 < len(fields)):
+					timeout = int(fields[fields.index("timeout") + 1]) or None
+				entries[member] = timeout
+		return entries
+
+	def members(self):
+		return set(self.entries())
+
+	def create_command(self):
+		return [ "ipset", "-exist", "create", self._name, self._set_type ] + self.create_options(0)
+
+	def _live_options(self):
+		"""Returns the type, timeout and maximum number of elements of the set
+		in the kernel or None if the set does not exist."""
+		result = subprocess.run([ "ipset", "list", "-terse", self._name ], stdout = subprocess.PIPE, stderr = subprocess.DEVNULL)
+		if result.returncode != 0:
+			return None
+		(set_type, timeout, maxelem) = (None, None, None)
+		for line in result.stdout.decode("ascii").split("\n"):
+			if line.startswith("Type:"):
+				set_type = line.split(":", maxsplit = 1)[1].strip()
+			elif line.startswith("Header:"):
+				fields = line.split()
+				if ("timeout" in fields) and (fields.index("timeout") + 1 < len(fields)):
+					timeout = int(fields[fields.index("timeout") + 1])
+				if ("maxelem" in fields) and (fields.index("maxelem") + 1 < len(fields)):
+					maxelem = int(fields[fields.index("maxelem") + 1])
+		return (set_type, timeout, maxelem)
+
+	def create(self):
+		"""Creates the set unless it already exists. The content of an
+		existing set is left untouched. If it exists with a different type or
+		timeout (e.g., because the set definition was changed), it is
+		replaced by a set with the new options which keeps all members and
+		their remaining timeouts."""
+		live_options = self._live_options()
+		if live_options is None:
+			subprocess.check_call(self.create_command())
+		elif live_options[:2] != (self._set_type, self._timeout):
+			print("Recreating ipset %s with changed options (type %s, timeout %s)." % (self._name, self._set_type, self._timeout), file = sys.stderr)
+			entries = self.entries()
+			tmp_name = self._name + self._TMP_SUFFIX
+			subprocess.call([ "ipset", "destroy", tmp_name ], stderr = subprocess.DEVNULL)
+			lines = [ " ".join([ "create", tmp_name, self._set_type ] + self.create_options(len(entries))) ]
+			for (member, timeout) in sorted(entries.items()):
+				if (timeout is not None) and (self._timeout is not None):
+					lines.append("add %s %s timeout %d" % (tmp_name, member, timeout))
+				else:
+					lines.append("add %s %s" % (tmp_name, member))
+			self._restore(lines + [ "swap %s %s" % (tmp_name, self._name), "destroy %s" % (tmp_name) ])
+
+	def add(self, member, timeout = None):
+		command = [ "ipset", "-exist", "add", self._name, member ]
+		if timeout is not None:
+			command += [ "timeout", str(timeout) ]
+		subprocess.check_call(command)
+
+	def delete(self, member):
+		subprocess.check_call([ "ipset", "-exist", "del", self._name, member ])
+
+	@staticmethod
+	def _restore(lines):
+		restore_data = "".join(line + "\n" for line in lines).encode("ascii")
+		subprocess.run([ "ipset", "restore", "-exist" ], input = restore_data, check = True)
+
+	def restore_commands(self, members, set_name = None):
+		"""Returns the 'ipset restore' lines that create and fill a set."""
+		set_name = set_name or self._name
+		yield " ".join([ "create", set_name, self._set_type ] + self.create_options(len(members)))
+		for member in members:
+			yield "add %s %s" % (set_name, member)
+
+	def replace(self, members):
+		"""Atomically replaces the whole content of the set."""
+		tmp_name = self._name + self._TMP_SUFFIX
+		subprocess.call([ "ipset", "destroy", tmp_name ], stderr = subprocess.DEVNULL)
+		self._restore(self.restore_commands(members, set_name = tmp_name))
+		if self.exists():
+			self._restore([ "swap %s %s" % (tmp_name, self._name), "destroy %s" % (tmp_name) ])
+		else:
+			self._restore([ "rename %s %s" % (tmp_name, self._name) ])
+
+	def update(self, members):
+		"""Brings the set to the given members. Returns the number of added
+		and removed entries."""
+		members = set(members)
+		live_options = self._live_options()
+		if live_options is None:
+			self.replace(sorted(members))
+			return (len(members), 0)
+		current_members = self.members()
+		added = sorted(members - current_members)
+		removed = sorted(current_members - members)
+		maxelem = live_options[2]
+		if (len(current_members) == 0) or (len(added) + len(removed) > len(members)) or ((maxelem is not None) and (len(members) > maxelem)):
+			# A complete reload is cheaper or the live set is too small for
+			# the new members; the replacement is sized for them
+			self.replace(sorted(members))
+		elif (len(added) > 0) or (len(removed) > 0):
+			self._restore([ "del %s %s" % (self._name, member) for member in removed ] + [ "add %s %s" % (self._name, member) for member in added ])
+		return (len(added), len(removed))
+
+class IPSetReference():
+	"""Refers to the sets of one or more objects (e.g., feeds) from within a
+	rule and yields the names of their ipsets. Subclasses look up the set
+	name of every referenced object in _set_name()."""
+	def __init__(self, names_str, config):
+		self._set_names = [ self._set_name(name, config) for name in multisplit(names_str) ]
+
+	@classmethod
+	def _set_name(cls, name, config):
+		raise NotImplementedError(cls.__name__)
+
+	def __iter__(self):
+		yield from self._set_names
@@ -19,9 +19,9 @@
 #
 #	Johannes Bauer <JohannesBauer@gmx.de>
 
+import os
 import re
 import sys
-import os
 import subprocess
 from pyipt.Tools import multisplit
 from pyipt.Exceptions import UnknownInterfaceException
@@ -33,9 +33,20 @@ class Interface():
 		self._config = config
 		self._interface_str = interface_str
 		self._interfaces = set()
-		for interface_name in multisplit(interface_str):
+		self._excluded = set()
+		interface_names = multisplit(interface_str)
+		for interface_name in interface_names:
 			self._add_interface_name(interface_name)
 		self._interfaces = sorted(list(self._interfaces))
+		# A negation otherwise stands for all other interfaces listed in the
+		# ruleset. Matching '! -i <excluded>' instead would also match
+		# interfaces that are not listed (e.g., lo or tunnels), so a single
+		# negation of a single interface (or interface pattern such as
+		# 'eth1.+') is only matched directly when the ruleset opts in.
+		self._negated = None
+		if self._config.get("options", { }).get("negate_unlisted_interfaces", False):
+			if (len(interface_names) == 1) and interface_names[0].startswith("!") and (len(self._excluded) == 1):
+				self._negated = list(self._excluded)[0]
 
 	def _add_interface_name(self, interface_str):
 		if interface_str.startswith("!"):
@@ -45,6 +56,7 @@ class Interface():
 				if interface_name != exclude_interface_name:
 					self._interfaces.add(interface)
 				else:
+					self._excluded.add(interface)
 					have_excluded = True
 			if not have_excluded:
 				print("Warning: Excluded interface '%s' not in list of interfaces at all (spec: %s)" % (exclude_interface_name, self._interface_str), file = sys.stderr)
@@ -59,6 +71,36 @@ class Interface():
 		return self._config["interfaces"].items()
 
 	def _get_ifaddress(self, ifname):
+		# Addresses are queried only once per generated ruleset when the
+		# configuration provides a cache for them
+		cache = self._config.get("ifaddr-cache")
+		if cache is None:
+			return list(self._query_ifaddress(ifname))
+		if ifname not in cache:
+			cache[ifname] = list(self._query_ifaddress(ifname))
+		return cache[ifname]
+
+	def _list_devices(self):
+		if "mock_interfaces" in self._config.get("options", { }):
+			prefix = "ip_addr_show_"
+			return sorted(filename[len(prefix) : -4] for filename in os.listdir(self._config["options"]["mock_interfaces"]) if filename.startswith(prefix) and filename.endswith(".txt"))
+		if self._config.get("metrics") is not None:
+			self._config["metrics"].inc("firewalld_ip_subprocess_total")
+		ip_output = subprocess.check_output([ "ip", "-o", "link", "show" ], stderr = subprocess.DEVNULL).decode("ascii")
+		devices = [ ]
+		for line in ip_output.split("\n"):
+			fields = line.split()
+			if len(fields) >= 2:
+				devices.append(fields[1].rstrip(":").split("@")[0])
+		return sorted(devices)
+
+	def _query_ifaddress(self, ifname):
+		if ifname.endswith("+"):
+			# Interface pattern, all matching devices that currently exist
+			for device in self._list_devices():
+				if device.startswith(ifname[:-1]):
+					yield from self._query_ifaddress(device)
+			return
 		try:
 			ip_output = None
 			if "mock_interfaces" in self._config.get("options", { }):
@@ -69,6 +111,8 @@ class Interface():
 				except FileNotFoundError:
 					pass
 			if ip_output is None:
+				if self._config.get("metrics") is not None:
+					self._config["metrics"].inc("firewalld_ip_subprocess_total")
 				ip_output = subprocess.check_output([ "ip", "addr", "show", ifname ], stderr = subprocess.DEVNULL)
 			ip_output = ip_output.decode("ascii")
 			for match in self._IP_ADDRESS_RE.finditer(ip_output):
@@ -97,5 +141,11 @@ class InterfaceAddress(Interface):
 				yield ifaddress
 
 class InterfaceName(Interface):
+	"""Yields tuples of the interface name (or pattern) to match and whether
+	the match is negated."""
 	def __iter__(self):
-		yield from self._interfaces
+		if self._negated is not None:
+			yield (self._negated, True)
+		else:
+			for ifname in self._interfaces:
+				yield (ifname, False)
@@ -0,0 +1,257 @@
+#	firewalld - Linux firewall daemon with time-based capabilities
+#	Copyright (C) 2020-2021 Johannes Bauer
+#
+#	This file is part of firewalld.
+#
+#	firewalld is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	firewalld is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with firewalld; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+class Match():
+	"""Typed intermediate representation of a single match or verdict of a
+	rule. Rules hold these objects instead of raw iptables arguments so that
+	passes operating on rules can inspect them without parsing strings.
+	Matches are immutable and compare by value, which allows sharing them in
+	the TokenTable; each one renders its iptables arguments only once."""
+	__slots__ = ( "_values", "_iptables_args" )
+	_FIELDS = ( )
+
+	def __init__(self, *values):
+		assert(len(values) == len(self._FIELDS))
+		self._values = values
+		self._iptables_args = None
+
+	def __getattr__(self, name):
+		if name.startswith("_"):
+			raise AttributeError(name)
+		try:
+			return self._values[self._FIELDS.index(name)]
+		except ValueError:
+			raise AttributeError(name)
+
+	def _render(self):
+		raise NotImplementedError(self.__class__.__name__)
+
+	def iptables_args(self):
+		if self._iptables_args is None:
+			self._iptables_args = tuple(self._render())
+		return self._iptables_args
+
+	def __eq__(self, other):
+		return (type(self) is type(other)) and (self._values == other._values)
+
+	def __hash__(self):
+		return hash((self.__class__.__name__, self._values))
+
+	def __repr__(self):
+		return "%s(%s)" % (self.__class__.__name__, ", ".join("%s=%s" % (field, repr(value)) for (field, value) in zip(self._FIELDS, self._values)))
+
+class InterfaceMatch(Match):
+	"""Input ('in') or output ('out') interface."""
+	__slots__ = ( )
+	_FIELDS = ( "direction", "name", "negated" )
+
+	def __init__(self, direction, name, negated = False):
+		super().__init__(direction, name, negated)
+
+	def _render(self):
+		if self.negated:
+			yield "!"
+		yield "-i" if (self.direction == "in") else "-o"
+		yield self.name
+
+class AddressMatch(Match):
+	"""Source ('src') or destination ('dst') address or CIDR network."""
+	__slots__ = ( )
+	_FIELDS = ( "direction", "network" )
+
+	def _render(self):
+		return ("-s" if (self.direction == "src") else "-d", self.network)
+
+class SetMatch(Match):
+	"""Source or destination address contained in an ipset."""
+	__slots__ = ( )
+	_FIELDS = ( "direction", "set_name" )
+
+	def _render(self):
+		return ("--match", "set", "--match-set", self.set_name, self.direction)
+
+class ProtocolMatch(Match):
+	__slots__ = ( )
+	_FIELDS = ( "proto", )
+
+	def _render(self):
+		return ("-p", self.proto)
+
+class PortMatch(Match):
+	"""Source or destination ports of a protocol, given as a tuple of
+	(begin, end) intervals. Unless multiport is requested, only a single
+	interval can be matched."""
+	__slots__ = ( )
+	_FIELDS = ( "direction", "proto", "intervals", "multiport" )
+
+	def __init__(self, direction, proto, intervals, multiport = False):
+		assert(multiport or (len(intervals) == 1))
+		super().__init__(direction, proto, tuple(intervals), multiport)
+
+	@staticmethod
+	def format_interval(begin, end):
+		return str(begin) if (begin == end) else "%d:%d" % (begin, end)
+
+	def _render(self):
+		option = "s" if (self.direction == "src") else "d"
+		ports = ",".join(self.format_interval(begin, end) for (begin, end) in self.intervals)
+		if self.multiport:
+			return ("-p", self.proto, "--match", "multiport", "--%sports" % (option), ports)
+		else:
+			return ("-p", self.proto, "--%sport" % (option), ports)
+
+class ICMPTypeMatch(Match):
+	__slots__ = ( )
+	_FIELDS = ( "icmp_type", )
+
+	def _render(self):
+		return ("-p", "icmp", "--icmp-type", self.icmp_type)
+
+class StateMatch(Match):
+	"""Connection tracking state, either through the 'state' or the
+	'conntrack' module. The latter can additionally match the original
+	destination port (begin, end) of a translated connection."""
+	__slots__ = ( )
+	_FIELDS = ( "states", "module", "orig_dport" )
+
+	def __init__(self, states, module = "state", orig_dport = None):
+		assert((orig_dport is None) or (module == "conntrack"))
+		super().__init__(tuple(states), module, orig_dport)
+
+	def _render(self):
+		if self.module == "state":
+			return ("--match", "state", "--state", ",".join(self.states))
+		args = ("--match", "conntrack", "--ctstate", ",".join(self.states))
+		if self.orig_dport is not None:
+			args += ("--ctorigdstport", PortMatch.format_interval(*self.orig_dport))
+		return args
+
+class LimitMatch(Match):
+	"""Rate limit with a single bucket for all matching packets."""
+	__slots__ = ( )
+	_FIELDS = ( "rate", "burst" )
+
+	def _render(self):
+		yield from ("--match", "limit", "--limit", self.rate)
+		if self.burst is not None:
+			yield from ("--limit-burst", str(self.burst))
+
+class HashLimitMatch(Match):
+	"""Rate limit with one bucket per address (or masked network). 'mode'
+	is a tuple of 'src' and/or 'dst'."""
+	__slots__ = ( )
+	_FIELDS = ( "rate", "burst", "mode", "name", "mask", "htable_size", "htable_expire" )
+	_MODES = {
+		"src":	"srcip",
+		"dst":	"dstip",
+	}
+
+	def __init__(self, rate, burst, mode, name, mask = None, htable_size = None, htable_expire = None):
+		super().__init__(rate, burst, tuple(mode), name, mask, htable_size, htable_expire)
+
+	def _render(self):
+		yield from ("--match", "hashlimit", "--hashlimit-upto", self.rate)
+		if self.burst is not None:
+			yield from ("--hashlimit-burst", str(self.burst))
+		yield from ("--hashlimit-mode", ",".join(self._MODES[direction] for direction in self.mode), "--hashlimit-name", self.name)
+		if self.mask is not None:
+			for direction in self.mode:
+				yield from ("--hashlimit-%smask" % (direction), str(self.mask))
+		if self.htable_size is not None:
+			yield from ("--hashlimit-htable-size", str(self.htable_size))
+		if self.htable_expire is not None:
+			yield from ("--hashlimit-htable-expire", str(self.htable_expire))
+
+class ConnLimitMatch(Match):
+	"""At most 'limit' concurrent connections per source or destination
+	('src' or 'dst') address or masked network."""
+	__slots__ = ( )
+	_FIELDS = ( "limit", "mask", "direction" )
+
+	def _render(self):
+		yield from ("--match", "connlimit", "--connlimit-upto", str(self.limit))
+		if self.mask is not None:
+			yield from ("--connlimit-mask", str(self.mask))
+		yield "--connlimit-saddr" if (self.direction == "src") else "--connlimit-daddr"
+
+class StatisticMatch(Match):
+	"""Matches every nth packet ('nth', value is n) or packets with a given
+	probability ('random', value is the probability)."""
+	__slots__ = ( )
+	_FIELDS = ( "mode", "value" )
+
+	def _render(self):
+		if self.mode == "nth":
+			return ("--match", "statistic", "--mode", "nth", "--every", str(self.value), "--packet", "0")
+		else:
+			return ("--match", "statistic", "--mode", "random", "--probability", "%.5f" % (self.value))
+
+class U32Match(Match):
+	__slots__ = ( )
+	_FIELDS = ( "expression", )
+
+	def _render(self):
+		return ("--match", "u32", "--u32", self.expression)
+
+class StringMatch(Match):
+	"""Case insensitive match of a byte string anywhere in the packet."""
+	__slots__ = ( )
+	_FIELDS = ( "data", )
+
+	def _render(self):
+		return ("--match", "string", "--hex-string", "|%s|" % (self.data.hex()), "--algo", "bm", "--icase")
+
+class Comment(Match):
+	__slots__ = ( )
+	_FIELDS = ( "text", )
+
+	def _render(self):
+		return ("-m", "comment", "--comment", self.text)
+
+class Goto(Match):
+	"""Continues in a user chain without returning to the current one."""
+	__slots__ = ( )
+	_FIELDS = ( "chain", )
+
+	def _render(self):
+		return ("-g", self.chain)
+
+class Verdict(Match):
+	"""Target of a rule together with the target's options."""
+	__slots__ = ( )
+	_FIELDS = ( "target", "options" )
+
+	def __init__(self, target, options = ( )):
+		super().__init__(target, tuple(options))
+
+	def _render(self):
+		return ("-j", self.target) + self.options
+
+def render_iptables(tokens):
+	"""Renders a sequence of Match objects and raw argument strings to a list
+	of iptables arguments."""
+	args = [ ]
+	for token in tokens:
+		if isinstance(token, Match):
+			args += token.iptables_args()
+		else:
+			args.append(token)
+	return args
@@ -0,0 +1,159 @@
+#	firewalld - Linux firewall daemon with time-based capabilities
+#	Copyright (C) 2020-2021 Johannes Bauer
+#
+#	This file is part of firewalld.
+#
+#	firewalld is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	firewalld is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with firewalld; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import os
+import time
+import bisect
+import threading
+import contextlib
+from pyipt.Tools import atomic_write
+
+class Histogram():
+	_DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+	def __init__(self, buckets = None):
+		self._buckets = buckets or self._DEFAULT_BUCKETS
+		self._counts = [ 0 ] * (len(self._buckets) + 1)
+		self._sum = 0
+		self._count = 0
+
+	def observe(self, value):
+		self._counts[bisect.bisect_left(self._buckets, value)] += 1
+		self._sum += value
+		self._count += 1
+
+	def samples(self):
+		"""Yields (suffix, extra label, value) tuples in Prometheus exposition
+		order, bucket counts being cumulative."""
+		cumulative = 0
+		for (bound, count) in zip(self._buckets, self._counts):
+			cumulative += count
+			yield ("_bucket", ("le", "%g" % (bound)), cumulative)
+		yield ("_bucket", ("le", "+Inf"), self._count)
+		yield ("_sum", None, self._sum)
+		yield ("_count", None, self._count)
+
+class Metrics():
+	"""Collects counters, gauges and histograms about the operation of the
+	daemon and writes them in the Prometheus text exposition format, e.g.,
+	to be picked up by the node exporter's textfile collector. Every metric
+	needs to be declared in _DEFINITIONS."""
+	_DEFINITIONS = {
+		"firewalld_generation_phase_seconds":	("histogram", "Time spent generating the ruleset, by phase."),
+		"firewalld_generations_total":			("counter", "Number of generated rulesets."),
+		"firewalld_apply_seconds":				("histogram", "Time spent applying a ruleset to the kernel."),
+		"firewalld_apply_commands_total":		("counter", "Number of iptables commands executed while applying rulesets."),
+		"firewalld_reapply_total":				("counter", "Number of times a ruleset was applied, by the input that changed."),
+		"firewalld_last_apply_timestamp_seconds":	("gauge", "Time at which a ruleset was last applied."),
+		"firewalld_dns_lookup_seconds":			("histogram", "Latency of live DNS lookups."),
+		"firewalld_dns_lookup_failures_total":	("counter", "Number of failed DNS lookups."),
+		"firewalld_ip_subprocess_total":		("counter", "Number of 'ip' subprocesses spawned to query interface addresses."),
+		"firewalld_rules":						("gauge", "Number of rules emitted into a chain by the current ruleset."),
+		"firewalld_resident_memory_bytes":		("gauge", "Resident set size of the daemon."),
+	}
+
+	def __init__(self):
+		self._values = { }
+		# DNS lookups may be performed from a refresh thread
+		self._lock = threading.Lock()
+
+	@staticmethod
+	def _key(name, labels):
+		return (name, tuple(sorted(labels.items())))
+
+	def _check_defined(self, name, metric_type):
+		if self._DEFINITIONS[name][0] != metric_type:
+			raise ValueError("Metric %s is a %s, not a %s." % (name, self._DEFINITIONS[name][0], metric_type))
+
+	def inc(self, name, value = 1, **labels):
+		self._check_defined(name, "counter")
+		key = self._key(name, labels)
+		with self._lock:
+			self._values[key] = self._values.get(key, 0) + value
+
+	def set(self, name, value, **labels):
+		self._check_defined(name, "gauge")
+		with self._lock:
+			self._values[self._key(name, labels)] = value
+
+	def observe(self, name, value, **labels):
+		self._check_defined(name, "histogram")
+		key = self._key(name, labels)
+		with self._lock:
+			if key not in self._values:
+				self._values[key] = Histogram()
+			self._values[key].observe(value)
+
+	def clear(self, name):
+		"""Removes all label sets of a metric, e.g., for gauges whose label
+		values (like chain names) may disappear."""
+		with self._lock:
+			self._values = { key: value for (key, value) in self._values.items() if key[0] != name }
+
+	@contextlib.contextmanager
+	def time(self, name, **labels):
+		t0 = time.monotonic()
+		try:
+			yield
+		finally:
+			self.observe(name, time.monotonic() - t0, **labels)
+
+	def update_resident_memory(self):
+		try:
+			with open("/proc/self/statm") as f:
+				resident_pages = int(f.read().split()[1])
+		except (FileNotFoundError, IndexError, ValueError):
+			return
+		self.set("firewalld_resident_memory_bytes", resident_pages * os.sysconf("SC_PAGE_SIZE"))
+
+	@staticmethod
+	def _format_labels(labels):
+		if len(labels) == 0:
+			return ""
+		return "{%s}" % (",".join("%s=\"%s\"" % (key, str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")) for (key, value) in labels))
+
+	@staticmethod
+	def _format_value(value):
+		if isinstance(value, int):
+			return str(value)
+		return repr(float(value))
+
+	def generate(self):
+		with self._lock:
+			values = dict(self._values)
+		for (name, (metric_type, help_text)) in sorted(self._DEFINITIONS.items()):
+			entries = sorted((key[1], value) for (key, value) in values.items() if key[0] == name)
+			if len(entries) == 0:
+				continue
+			yield "# HELP %s %s" % (name, help_text)
+			yield "# TYPE %s %s" % (name, metric_type)
+			for (labels, value) in entries:
+				if metric_type == "histogram":
+					for (suffix, extra_label, sample) in value.samples():
+						sample_labels = labels if (extra_label is None) else labels + (extra_label, )
+						yield "%s%s%s %s" % (name, suffix, self._format_labels(sample_labels), self._format_value(sample))
+				else:
+					yield "%s%s %s" % (name, self._format_labels(labels), self._format_value(value))
+
+	def write(self, filename):
+		with atomic_write(filename) as f:
+			for line in self.generate():
+				print(line, file = f)
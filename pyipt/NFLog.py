@@ -0,0 +1,50 @@
+#	firewalld - Linux firewall daemon with time-based capabilities
+#	Copyright (C) 2020-2021 Johannes Bauer
+#
+#	This file is part of firewalld.
+#
+#	firewalld is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	firewalld is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with firewalld; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+from pyipt.Matches import Verdict
+from pyipt.Exceptions import UnknownTypeError
+
+class NFLog():
+	"""Logging via NFLOG instead of LOG. Packets are passed to a userspace
+	logging daemon (e.g., ulogd) through a netlink group instead of being
+	written to the kernel log one printk at a time. 'threshold' batches that
+	many packets into one netlink message and 'size' limits how many bytes
+	of each packet are copied."""
+	_KNOWN_KEYS = set([ "group", "threshold", "size" ])
+
+	def __init__(self, nflog_dict):
+		self._nflog = nflog_dict
+		unknown_keys = set(self._nflog) - self._KNOWN_KEYS
+		if len(unknown_keys) > 0:
+			raise UnknownTypeError("Unknown NFLOG option(s) %s: %s" % (", ".join(sorted(unknown_keys)), str(self._nflog)))
+		for (key, value) in self._nflog.items():
+			if not isinstance(value, int):
+				raise UnknownTypeError("NFLOG option '%s' must be an integer: %s" % (key, str(self._nflog)))
+
+	def verdict(self, prefix = None):
+		options = [ "--nflog-group", str(self._nflog.get("group", 0)) ]
+		if prefix is not None:
+			options += [ "--nflog-prefix", prefix ]
+		if "threshold" in self._nflog:
+			options += [ "--nflog-threshold", str(self._nflog["threshold"]) ]
+		if "size" in self._nflog:
+			options += [ "--nflog-size", str(self._nflog["size"]) ]
+		return Verdict("NFLOG", options)
@@ -0,0 +1,109 @@
+#	firewalld - Linux firewall daemon with time-based capabilities
+#	Copyright (C) 2020-2021 Johannes Bauer
+#
+#	This file is part of firewalld.
+#
+#	firewalld is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	firewalld is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with firewalld; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import os
+import socket
+import struct
+
+class NFLogSocket():
+	"""Receives packets that iptables rules pass to an NFLOG group directly
+	through a netfilter netlink socket (nfnetlink_log), without requiring
+	libnetfilter_log. Iterating yields the raw IP packets. Binding to a
+	group requires CAP_NET_ADMIN."""
+	_NETLINK_NETFILTER = 12
+	_NFNL_SUBSYS_ULOG = 4
+	_NFULNL_MSG_PACKET = 0
+	_NFULNL_MSG_CONFIG = 1
+	_NFULA_PAYLOAD = 9
+	_NFULA_CFG_CMD = 1
+	_NFULA_CFG_MODE = 2
+	_NFULNL_CFG_CMD_BIND = 1
+	_NFULNL_COPY_PACKET = 2
+	_NLMSG_ERROR = 2
+	_NLM_F_REQUEST = 1
+	_NLM_F_ACK = 4
+	_NLA_TYPE_MASK = 0x3fff
+	_NLMSGHDR = struct.Struct("=LHHLL")
+	_NLATTR = struct.Struct("=HH")
+
+	def __init__(self, group, copy_range = 0xffff):
+		self._group = group
+		self._seq = 0
+		self._sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, self._NETLINK_NETFILTER)
+		self._sock.bind((0, 0))
+		self._configure(self._attribute(self._NFULA_CFG_CMD, bytes([ self._NFULNL_CFG_CMD_BIND ])))
+		self._configure(self._attribute(self._NFULA_CFG_MODE, struct.pack(">LBB", copy_range, self._NFULNL_COPY_PACKET, 0)))
+
+	@staticmethod
+	def _align(length):
+		return (length + 3) & ~3
+
+	@classmethod
+	def _attribute(cls, attr_type, payload):
+		attribute = cls._NLATTR.pack(cls._NLATTR.size + len(payload), attr_type) + payload
+		return attribute + bytes(cls._align(len(attribute)) - len(attribute))
+
+	def _configure(self, attributes):
+		self._seq += 1
+		# nfgenmsg: address family, version and the group (big endian)
+		body = struct.pack("=BB", socket.AF_INET, 0) + struct.pack(">H", self._group) + attributes
+		msg_type = (self._NFNL_SUBSYS_ULOG << 8) | self._NFULNL_MSG_CONFIG
+		self._sock.send(self._NLMSGHDR.pack(self._NLMSGHDR.size + len(body), msg_type, self._NLM_F_REQUEST | self._NLM_F_ACK, self._seq, 0) + body)
+		for (msg_type, payload) in self._messages(self._sock.recv(4096)):
+			if msg_type == self._NLMSG_ERROR:
+				(error, ) = struct.unpack("=i", payload[:4])
+				if error != 0:
+					raise OSError(-error, "Configuring NFLOG group %d failed: %s" % (self._group, os.strerror(-error)))
+
+	@classmethod
+	def _messages(cls, data):
+		offset = 0
+		while offset + cls._NLMSGHDR.size <= len(data):
+			(length, msg_type, flags, seq, pid) = cls._NLMSGHDR.unpack_from(data, offset)
+			if length < cls._NLMSGHDR.size:
+				break
+			yield (msg_type, data[offset + cls._NLMSGHDR.size : offset + length])
+			offset += cls._align(length)
+
+	@classmethod
+	def _attributes(cls, data):
+		offset = 0
+		while offset + cls._NLATTR.size <= len(data):
+			(length, attr_type) = cls._NLATTR.unpack_from(data, offset)
+			if length < cls._NLATTR.size:
+				break
+			yield (attr_type & cls._NLA_TYPE_MASK, data[offset + cls._NLATTR.size : offset + length])
+			offset += cls._align(length)
+
+	def __iter__(self):
+		packet_type = (self._NFNL_SUBSYS_ULOG << 8) | self._NFULNL_MSG_PACKET
+		while True:
+			data = self._sock.recv(256 * 1024)
+			for (msg_type, payload) in self._messages(data):
+				if msg_type != packet_type:
+					continue
+				# Attributes follow the 4 bytes of nfgenmsg
+				for (attr_type, value) in self._attributes(payload[4:]):
+					if attr_type == self._NFULA_PAYLOAD:
+						yield value
+
+	def close(self):
+		self._sock.close()
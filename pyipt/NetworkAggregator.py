@@ -0,0 +1,110 @@
+#	firewalld - Linux firewall daemon with time-based capabilities
+#	Copyright (C) 2020-2021 Johannes Bauer
+#
+#	This file is part of firewalld.
+#
+#	firewalld is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	firewalld is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with firewalld; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import sys
+from pyipt.Exceptions import InvalidNetworkException
+
+class NetworkAggregator():
+	"""Aggregates IPv4 addresses and networks into the minimal list of CIDR
+	networks covering exactly the same addresses: overlapping networks and
+	networks contained in others are merged, adjacent networks are joined
+	into their common supernet wherever possible. Networks are kept as
+	integer (first, last) address intervals, which for lists of several
+	hundred thousand entries needs far less memory than a bitwise prefix
+	tree while giving the identical result."""
+
+	def __init__(self):
+		self._intervals = [ ]
+
+	@staticmethod
+	def parse_network(network_str):
+		"""Parses 'a.b.c.d' or 'a.b.c.d/n' and returns the (first, last)
+		address interval as integers."""
+		(address, _, cidr) = network_str.partition("/")
+		octets = address.split(".")
+		try:
+			if len(octets) != 4:
+				raise ValueError("four octets required")
+			octets = [ int(octet) for octet in octets ]
+			if any((octet < 0) or (octet > 255) for octet in octets):
+				raise ValueError("octet out of range")
+			cidr = int(cidr) if (cidr != "") else 32
+			if (cidr < 0) or (cidr > 32):
+				raise ValueError("prefix length out of range")
+		except ValueError as e:
+			raise InvalidNetworkException("Invalid IPv4 network '%s': %s" % (network_str, str(e)))
+		address = (octets[0] << 24) | (octets[1] << 16) | (octets[2] << 8) | octets[3]
+		hostmask = (1 << (32 - cidr)) - 1
+		first = address & ~hostmask
+		return (first, first | hostmask)
+
+	@staticmethod
+	def format_network(address, cidr):
+		return "%d.%d.%d.%d/%d" % ((address >> 24) & 0xff, (address >> 16) & 0xff, (address >> 8) & 0xff, address & 0xff, cidr)
+
+	def add(self, network_str):
+		self._intervals.append(self.parse_network(network_str))
+
+	def add_file(self, filename):
+		"""Reads a list of networks line by line without keeping the file in
+		memory. Empty lines and comments (starting with '#' or ';') are
+		ignored, as is everything after the first whitespace-separated field.
+		Lines that cannot be parsed are skipped with a warning."""
+		with open(filename) as f:
+			for (lineno, line) in enumerate(f, 1):
+				line = line.split("#", maxsplit = 1)[0].split(";", maxsplit = 1)[0].strip()
+				if line == "":
+					continue
+				try:
+					self.add(line.split()[0])
+				except InvalidNetworkException as e:
+					print("Warning: Ignoring %s:%d: %s" % (filename, lineno, str(e)), file = sys.stderr)
+
+	def _merged_intervals(self):
+		merged = [ ]
+		for (first, last) in sorted(self._intervals):
+			if (len(merged) > 0) and (first <= merged[-1][1] + 1):
+				if last > merged[-1][1]:
+					merged[-1][1] = last
+			else:
+				merged.append([ first, last ])
+		return merged
+
+	@staticmethod
+	def _interval_networks(first, last):
+		# Split the interval into the largest aligned blocks
+		while first <= last:
+			size = (first & -first) if (first != 0) else (1 << 32)
+			while first + size - 1 > last:
+				size >>= 1
+			yield (first, 32 - size.bit_length() + 1)
+			first += size
+
+	def __iter__(self):
+		for (first, last) in self._merged_intervals():
+			for (address, cidr) in self._interval_networks(first, last):
+				yield self.format_network(address, cidr)
+
+if __name__ == "__main__":
+	aggregator = NetworkAggregator()
+	for network in [ "10.0.0.0/25", "10.0.0.128/25", "10.0.1.0/24", "10.0.1.17", "192.168.0.1", "192.168.0.2", "192.168.0.3", "0.0.0.0/1", "127.1.2.3/8" ]:
+		aggregator.add(network)
+	print(list(aggregator))
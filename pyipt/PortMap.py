@@ -68,6 +68,11 @@ class PortMap():
 				(range_start, range_end) = (port, port)
 		add_range(range_start, range_end)
 
+	@property
+	def ports(self):
+		self._finalize()
+		return self._ports
+
 	@property
 	def ranges(self):
 		self._finalize()
@@ -0,0 +1,79 @@
+#	firewalld - Linux firewall daemon with time-based capabilities
+#	Copyright (C) 2020-2021 Johannes Bauer
+#
+#	This file is part of firewalld.
+#
+#	firewalld is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	firewalld is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with firewalld; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import re
+import json
+import hashlib
+from pyipt.Matches import LimitMatch, HashLimitMatch
+from pyipt.Exceptions import InvalidRateLimitException
+
+class RateLimit():
+	"""A rate limit is either given as a simple rate string (e.g., "10/min"),
+	which applies globally to all packets matching the rule, or as a
+	dictionary. When the dictionary contains a "per" key ("src", "dst" or
+	"src,dst"), separate buckets are kept per address (hashlimit), otherwise
+	a single bucket is used (limit). Identical hashlimit definitions share
+	their buckets unless they are given distinct names."""
+	_RATE_RE = re.compile(r"\d+/(sec|second|min|minute|hour|day)")
+	_PER_MODES = set([ "src", "dst", "src,dst" ])
+	_KNOWN_KEYS = set([ "rate", "burst", "per", "mask", "htable-size", "htable-expire", "name" ])
+	_INTEGER_KEYS = [ "burst", "mask", "htable-size", "htable-expire" ]
+
+	def __init__(self, limit):
+		if isinstance(limit, str):
+			limit = { "rate": limit }
+		if not isinstance(limit, dict):
+			raise InvalidRateLimitException("Rate limit must be a rate string or a dictionary: %s" % (str(limit)))
+		self._limit = limit
+		unknown_keys = set(self._limit) - self._KNOWN_KEYS
+		if len(unknown_keys) > 0:
+			raise InvalidRateLimitException("Unknown rate limit option(s) %s: %s" % (", ".join(sorted(unknown_keys)), str(self._limit)))
+		if (not isinstance(self._limit.get("rate"), str)) or (self._RATE_RE.fullmatch(self._limit["rate"]) is None):
+			raise InvalidRateLimitException("Rate limit requires a 'rate' of the form '10/min': %s" % (str(self._limit)))
+		for key in self._INTEGER_KEYS:
+			if (key in self._limit) and ((not isinstance(self._limit[key], int)) or (self._limit[key] < 0)):
+				raise InvalidRateLimitException("Rate limit option '%s' must be a non-negative integer: %s" % (key, str(self._limit)))
+		if ("name" in self._limit) and (not isinstance(self._limit["name"], str)):
+			raise InvalidRateLimitException("Rate limit option 'name' must be a string: %s" % (str(self._limit)))
+		if ("per" in self._limit) and ((not isinstance(self._limit["per"], str)) or (self._limit["per"] not in self._PER_MODES)):
+			raise InvalidRateLimitException("Rate limit 'per' must be one of %s: %s" % (", ".join(sorted(self._PER_MODES)), str(self._limit)))
+		if ("per" not in self._limit) and any(key in self._limit for key in [ "mask", "htable-size", "htable-expire", "name" ]):
+			raise InvalidRateLimitException("Rate limit options 'mask', 'htable-size', 'htable-expire' and 'name' require 'per': %s" % (str(self._limit)))
+
+	@property
+	def per_address(self):
+		return "per" in self._limit
+
+	@property
+	def name(self):
+		if "name" in self._limit:
+			return self._limit["name"]
+		# hashlimit names are limited to 15 characters
+		return "fw" + hashlib.md5(json.dumps(self._limit, sort_keys = True).encode("utf-8")).hexdigest()[:12]
+
+	def match(self):
+		if not self.per_address:
+			return LimitMatch(self._limit["rate"], self._limit.get("burst"))
+		else:
+			return HashLimitMatch(self._limit["rate"], self._limit.get("burst"), self._limit["per"].split(","), self.name, mask = self._limit.get("mask"), htable_size = self._limit.get("htable-size"), htable_expire = self._limit.get("htable-expire"))
+
+	def __str__(self):
+		return "RateLimit<%s>" % (str(self._limit))
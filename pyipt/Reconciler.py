@@ -0,0 +1,147 @@
+#	firewalld - Linux firewall daemon with time-based capabilities
+#	Copyright (C) 2020-2021 Johannes Bauer
+#
+#	This file is part of firewalld.
+#
+#	firewalld is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	firewalld is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with firewalld; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import re
+import sys
+import json
+import hashlib
+import subprocess
+from pyipt.Tools import atomic_write
+
+class KernelState():
+	"""Canonicalized view of the live kernel tables as reported by
+	iptables-save. Packet and byte counters are discarded, the remaining
+	chain policies and rules are kept verbatim (in the normalized form in
+	which the kernel reports them)."""
+	_TARGET_RE = re.compile(r"\s-[jg] (?P<target>\S+)")
+
+	def __init__(self, save_output):
+		self._chains = { }
+		table = None
+		for line in save_output.split("\n"):
+			if (line == "") or line.startswith("#") or (line == "COMMIT"):
+				continue
+			if line.startswith("*"):
+				table = line[1:]
+			elif line.startswith(":"):
+				(chain, policy) = line[1:].split()[:2]
+				self._chains["%s.%s" % (table, chain)] = {
+					"policy":	policy,
+					"rules":	[ ],
+				}
+			elif line.startswith("-A "):
+				chain = line.split()[1]
+				self._chains["%s.%s" % (table, chain)]["rules"].append(line)
+
+	@classmethod
+	def read(cls):
+		try:
+			save_output = subprocess.check_output([ "iptables-save" ], stderr = subprocess.DEVNULL).decode("utf-8")
+		except (FileNotFoundError, subprocess.CalledProcessError) as e:
+			print("Warning: Unable to read live kernel ruleset: %s" % (str(e)), file = sys.stderr)
+			return None
+		return cls(save_output)
+
+	def _hash_chain(self, chain, hashval, visited):
+		visited.add(chain)
+		content = self._chains[chain]
+		hashval.update(("%s %s\n" % (chain, content["policy"])).encode("utf-8"))
+		table = chain.split(".", maxsplit = 1)[0]
+		for rule in content["rules"]:
+			hashval.update((rule + "\n").encode("utf-8"))
+			match = self._TARGET_RE.search(rule)
+			if match is not None:
+				target = "%s.%s" % (table, match.groupdict()["target"])
+				if (target in self._chains) and (target not in visited):
+					self._hash_chain(target, hashval, visited)
+
+	def digest(self, chain):
+		"""Returns a digest over the policy and rules of a chain including all
+		user chains it jumps to, or None if the chain does not exist."""
+		if chain not in self._chains:
+			return None
+		hashval = hashlib.md5()
+		self._hash_chain(chain, hashval, set())
+		return hashval.hexdigest()
+
+class Reconciler():
+	"""iptables-save reports rules in a normalized form which differs from
+	the commands that were used to create them (option order, implicit
+	matches, address masks). Instead of trying to replicate that
+	normalization, the Reconciler records for every chain the hash of the
+	generated commands together with the digest of what the kernel reported
+	directly after those commands were applied. A chain matches the live
+	state if both are unchanged. Without a file to keep the records in,
+	nothing is known on startup and all chains are considered differing."""
+	def __init__(self, filename = None):
+		self._filename = filename
+		self._applied = { }
+		if self._filename is not None:
+			try:
+				with open(self._filename) as f:
+					self._applied = json.load(f)
+			except (FileNotFoundError, json.decoder.JSONDecodeError):
+				pass
+
+	def _save(self):
+		if self._filename is None:
+			return
+		with atomic_write(self._filename) as f:
+			json.dump(self._applied, f, indent = 4, sort_keys = True)
+
+	def forget(self):
+		"""Discards all records so that every chain is considered
+		differing, e.g., when the live state cannot be determined."""
+		self._applied = { }
+
+	def differing_chains(self, ruleset, kernel_state = None):
+		"""Returns all chains of the ruleset that need to be applied. If a
+		kernel state is given, chains whose live content does not match what
+		was recorded are also considered differing, otherwise the kernel is
+		assumed to still hold what was last applied."""
+		chains = [ ]
+		for (chain, generated_hash) in ruleset.chain_hashes().items():
+			applied = self._applied.get(chain)
+			if (applied is None) or (applied["generated"] != generated_hash):
+				chains.append(chain)
+			elif (kernel_state is not None) and (applied["live"] != kernel_state.digest(chain)):
+				chains.append(chain)
+		return chains
+
+	def record(self, ruleset):
+		kernel_state = KernelState.read()
+		for (chain, generated_hash) in ruleset.chain_hashes().items():
+			if kernel_state is None:
+				self._applied.pop(chain, None)
+			else:
+				self._applied[chain] = {
+					"generated":	generated_hash,
+					"live":			kernel_state.digest(chain),
+				}
+		self._save()
+
+	def drifted_chains(self):
+		"""Returns all chains whose live content differs from what was last
+		applied, i.e., which were modified by some other tool."""
+		kernel_state = KernelState.read()
+		if kernel_state is None:
+			return [ ]
+		return sorted(chain for (chain, applied) in self._applied.items() if kernel_state.digest(chain) != applied["live"])
@@ -0,0 +1,124 @@
+#	firewalld - Linux firewall daemon with time-based capabilities
+#	Copyright (C) 2020-2021 Johannes Bauer
+#
+#	This file is part of firewalld.
+#
+#	firewalld is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	firewalld is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with firewalld; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import sys
+import json
+import time
+import threading
+from pyipt.Tools import atomic_write
+
+class Resolver():
+	"""The Resolver performs all DNS lookups of hostnames. When given a
+	snapshot filename, it remembers the last known good answer for every
+	hostname and persists it. A ruleset can then be generated from the
+	snapshot alone (e.g., directly after a reboot when upstream DNS is not
+	reachable yet) and the answers are refreshed afterwards. If a live lookup
+	fails, the last known good answer is used instead of an empty result."""
+	def __init__(self, snapshot_filename = None, metrics = None):
+		self._snapshot_filename = snapshot_filename
+		self._metrics = metrics
+		self._snapshot = { }
+		self._dirty = False
+		self._use_snapshot = False
+		self._generation_answers = { }
+		self._refresh_thread = None
+		self._refreshed = threading.Event()
+		self._lock = threading.Lock()
+		if self._snapshot_filename is not None:
+			self._load_snapshot()
+
+	@property
+	def refresh_pending(self):
+		"""True if answers were taken from the snapshot and no refresh has
+		been started since."""
+		return self._use_snapshot and (self._refresh_thread is None)
+
+	def _load_snapshot(self):
+		try:
+			with open(self._snapshot_filename) as f:
+				self._snapshot = { hostname: sorted(addresses) for (hostname, addresses) in json.load(f).items() }
+		except FileNotFoundError:
+			return
+		except (json.decoder.JSONDecodeError, AttributeError) as e:
+			print("Warning: Ignoring corrupt DNS snapshot %s: %s" % (self._snapshot_filename, str(e)), file = sys.stderr)
+			return
+		self._use_snapshot = len(self._snapshot) > 0
+
+	def save(self):
+		if (self._snapshot_filename is None) or (not self._dirty):
+			return
+		with self._lock, atomic_write(self._snapshot_filename) as f:
+			json.dump(self._snapshot, f, indent = 4, sort_keys = True)
+			self._dirty = False
+
+	def _lookup(self, hostname):
+		# Only import socket when a live lookup is actually performed, it is
+		# comparatively expensive and not needed when using the snapshot.
+		import socket
+		t0 = time.monotonic()
+		try:
+			(name, aliaslist, addresslist) = socket.gethostbyname_ex(hostname)
+		except socket.gaierror as e:
+			if self._metrics is not None:
+				self._metrics.inc("firewalld_dns_lookup_failures_total")
+			if hostname in self._snapshot:
+				print("Warning: Unable to resolve hostname %s, using last known good answer %s: %s" % (hostname, ", ".join(self._snapshot[hostname]), str(e)), file = sys.stderr)
+				return self._snapshot[hostname]
+			print("Warning: Unable to resolve hostname %s: %s" % (hostname, str(e)), file = sys.stderr)
+			return [ ]
+		finally:
+			if self._metrics is not None:
+				self._metrics.observe("firewalld_dns_lookup_seconds", time.monotonic() - t0)
+
+		addresses = sorted(set(addresslist))
+		with self._lock:
+			if self._snapshot.get(hostname) != addresses:
+				self._snapshot[hostname] = addresses
+				self._dirty = True
+		return addresses
+
+	def new_generation(self):
+		"""Forgets all answers given for the previous ruleset generation.
+		Within one generation, every hostname is looked up at most once."""
+		self._generation_answers = { }
+
+	def resolve(self, hostname):
+		if hostname not in self._generation_answers:
+			if self._use_snapshot and (hostname in self._snapshot):
+				self._generation_answers[hostname] = self._snapshot[hostname]
+			else:
+				self._generation_answers[hostname] = self._lookup(hostname)
+		return self._generation_answers[hostname]
+
+	def refresh(self):
+		"""Performs a live lookup of all hostnames in the snapshot. Afterwards,
+		all subsequent resolutions are live lookups again."""
+		for hostname in list(self._snapshot):
+			self._lookup(hostname)
+		self._use_snapshot = False
+		self._refreshed.set()
+
+	def start_refresh(self):
+		self._refresh_thread = threading.Thread(target = self.refresh, daemon = True)
+		self._refresh_thread.start()
+
+	def wait_refreshed(self, timeout = None):
+		return self._refreshed.wait(timeout)
@@ -0,0 +1,70 @@
+#	firewalld - Linux firewall daemon with time-based capabilities
+#	Copyright (C) 2020-2021 Johannes Bauer
+#
+#	This file is part of firewalld.
+#
+#	firewalld is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	firewalld is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with firewalld; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import json
+import hashlib
+import collections
+from pyipt.Tools import atomic_write
+
+class RuleTable():
+	"""Assigns every JSON rule a short ID which is used as the comment of
+	all kernel rules it expands to and in its log prefixes, instead of the
+	free-text comment. The ID only depends on the chain and the rule source,
+	so it remains stable when other rules are added, removed or reordered.
+	The table maps IDs back to the file, chain, index and comment of the
+	rule and is written next to the applied ruleset for tools that evaluate
+	counters or logs."""
+	_ID_PREFIX = "fw"
+	_ID_LENGTH = 8
+
+	def __init__(self):
+		self._entries = { }
+		self._occurrences = collections.Counter()
+
+	def assign(self, chain_name, rule_src, origin, comment = None):
+		key = json.dumps([ chain_name, rule_src ], sort_keys = True)
+		# Identical rules within the same chain are told apart by occurrence
+		occurrence = self._occurrences[key]
+		self._occurrences[key] += 1
+		key += "#%d" % (occurrence)
+		while True:
+			rule_id = self._ID_PREFIX + hashlib.md5(key.encode("utf-8")).hexdigest()[:self._ID_LENGTH]
+			if rule_id not in self._entries:
+				break
+			key += "+"
+		(filename, index) = origin
+		self._entries[rule_id] = {
+			"chain":	chain_name,
+			"file":		filename,
+			"index":	index,
+			"comment":	comment,
+		}
+		return rule_id
+
+	def __getitem__(self, rule_id):
+		return self._entries[rule_id]
+
+	def __len__(self):
+		return len(self._entries)
+
+	def write(self, filename):
+		with atomic_write(filename) as f:
+			json.dump(self._entries, f, indent = 4, sort_keys = True)
@@ -20,11 +20,37 @@
 #	Johannes Bauer <JohannesBauer@gmx.de>
 
 import os
+import array
 import itertools
 import datetime
 import subprocess
 import hashlib
 from pyipt.CmdlineEscape import CmdlineEscape
+from pyipt.Matches import render_iptables
+
+class TokenTable():
+	"""Maps every distinct argument string or Match object to a small
+	integer so that rules can store their arguments as compact index arrays.
+	Every token is only stored once, regardless of how many rules use it."""
+	__slots__ = ( "_indices", "_tokens" )
+
+	def __init__(self):
+		self._indices = { }
+		self._tokens = [ ]
+
+	def index(self, token):
+		index = self._indices.get(token)
+		if index is None:
+			index = len(self._tokens)
+			self._indices[token] = index
+			self._tokens.append(token)
+		return index
+
+	def __getitem__(self, index):
+		return self._tokens[index]
+
+	def __len__(self):
+		return len(self._tokens)
 
 class Rule():
 	"""The Rule is the most basic abstraction, only slightly above a single
@@ -35,24 +61,58 @@ class Rule():
 	[ [ "-p", "tcp" ], [ "-p", "udp" ] ], [ "-j", "REJECT" ]
 
 	The cross product of all components is then used to create iptables rules.
+
+	Options consist of typed Match objects (e.g., ProtocolMatch("tcp")
+	instead of [ "-p", "tcp" ]), raw argument strings or a mix of both. The
+	iptables arguments are only rendered when commands are generated.
+
+	Once a rule is complete, it is compacted: all arguments are replaced by
+	their index in the TokenTable of the Ruleset and stored in a single
+	array, together with two arrays that describe where each option and each
+	component starts. The components are only materialized again when
+	commands are generated. A rule that is reused in the Ruleset of a later
+	generation is moved over to its TokenTable, so that tables of previous
+	generations are freed together with their rulesets.
 	"""
+	__slots__ = ( "_component_names", "_components", "_token_table", "_tokens", "_option_bounds", "_component_bounds" )
+
 	def __init__(self):
 		self._component_names = [ ]
 		self._components = [ ]
+		self._token_table = None
+		self._tokens = None
+		self._option_bounds = None
+		self._component_bounds = None
+
+	@property
+	def compacted(self):
+		return self._tokens is not None
+
+	@property
+	def components(self):
+		if not self.compacted:
+			return self._components
+		tokens = [ self._token_table[index] for index in self._tokens ]
+		options = [ tuple(tokens[begin : end]) for (begin, end) in zip(self._option_bounds, self._option_bounds[1:]) ]
+		return [ options[begin : end] for (begin, end) in zip(self._component_bounds, self._component_bounds[1:]) ]
 
 	@property
 	def has_empty_group(self):
+		if self.compacted:
+			return any(self._component_bounds[cid] == self._component_bounds[cid + 1] for cid in range(len(self._component_bounds) - 1))
 		for component in self._components:
 			if len(component) == 0:
 				return True
 		return False
 
 	def add_fixed(self, *fixed_parts):
+		assert(not self.compacted)
 		for fixed_part in fixed_parts:
 			self._component_names.append(None)
 			self._components.append((fixed_part, ))
 
 	def add_group(self, name, members = None):
+		assert(not self.compacted)
 		self._component_names.append(name)
 		group = [ ]
 		self._components.append(group)
@@ -60,26 +120,58 @@ class Rule():
 			group += members
 		return group
 
-	def generate_commands(self):
-		for permutation in itertools.product(*self._components):
-			command = [ ]
+	def compact(self, token_table):
+		if self.compacted:
+			if self._token_table is not token_table:
+				self._tokens = array.array("I", [ token_table.index(self._token_table[index]) for index in self._tokens ])
+				self._token_table = token_table
+			return
+		tokens = [ ]
+		option_bounds = [ 0 ]
+		component_bounds = [ 0 ]
+		for component in self._components:
+			for option in component:
+				tokens += option
+				option_bounds.append(len(tokens))
+			component_bounds.append(len(option_bounds) - 1)
+		tokens = array.array("I", [ token_table.index(token) for token in tokens ])
+		option_bounds = array.array("I", option_bounds)
+		component_bounds = array.array("I", component_bounds)
+		self._component_names = tuple(self._component_names)
+		self._components = None
+		self._token_table = token_table
+		self._tokens = tokens
+		self._option_bounds = option_bounds
+		self._component_bounds = component_bounds
+
+	def generate_ir(self):
+		"""Yields the unrendered tokens (Match objects and raw strings) of
+		every command of the rule."""
+		for permutation in itertools.product(*self.components):
+			tokens = [ ]
 			for component in permutation:
-				command += component
-			yield command
+				tokens += component
+			yield tokens
+
+	def generate_commands(self):
+		for tokens in self.generate_ir():
+			yield render_iptables(tokens)
 
 	def dump(self, prefix = "", file = None):
-		for (cid, (component_name, components)) in enumerate(zip(self._component_names, self._components)):
+		for (cid, (component_name, components)) in enumerate(zip(self._component_names, self.components)):
 			print("%s%d: %s" % (prefix, cid, component_name or "(static)"), file = file)
 			for component in components:
-				print("%s    -> %s" % (prefix, str(component)), file = file)
+				print("%s    -> %s" % (prefix, str(tuple(render_iptables(component)))), file = file)
 
 	def __str__(self):
-		return "Rule<%s>" % (str(self._components))
+		return "Rule<%s>" % (str(self.components))
 
 class Rules():
 	"""Every entry in the JSON configuration corresponds to one Rules instance.
 	For example, a port forwarding entry might contain rules for different
 	chains (e.g., FORWARD and nat.PREROUTING)."""
+	__slots__ = ( "_name", "_rules" )
+
 	def __init__(self, name):
 		self._name = name
 		self._rules = [ ]
@@ -93,19 +185,35 @@ class Rules():
 		self._rules.append(rule)
 		return rule
 
+	def append(self, rule):
+		self._rules.append(rule)
+
+	def compact(self, token_table):
+		for rule in self._rules:
+			rule.compact(token_table)
+		self._rules = tuple(self._rules)
+
 	def __iter__(self):
 		return iter(self._rules)
 
+	def __len__(self):
+		return len(self._rules)
+
 	def __str__(self):
 		return " + ".join(str(rule) for rule in self._rules)
 
 class Ruleset():
 	"""The Ruleset is the whole firewall configuration, i.e., contains all
 	commands that are passed down to iptables."""
+	__slots__ = ( "_datapoints", "_rules", "_metadata", "_token_table" )
+	MAX_CHAIN_NAME_LENGTH = 28
+	SHADOW_SUFFIX_LENGTH = len("_v99")
+
 	def __init__(self, metadata):
 		self._datapoints = [ ]
 		self._rules = [ ]
 		self._metadata = metadata
+		self._token_table = TokenTable()
 
 	@property
 	def metadata(self):
@@ -118,20 +226,95 @@ class Ruleset():
 		mtime = round(os.stat(filename).st_mtime * 1000000)
 		self.add_datapoint(datapoint_name, str(mtime))
 
+	@property
+	def rules(self):
+		return iter(self._rules)
+
 	def add_rules(self, rules):
+		rules.compact(self._token_table)
 		self._rules.append(rules)
 
+	def replace_rules(self, rules_list):
+		self._rules = [ ]
+		for rules in rules_list:
+			self.add_rules(rules)
+
 	def generate(self):
 		for rules in self._rules:
 			for rule in rules:
 				yield from rule.generate_commands()
 
+	@classmethod
+	def split_table(cls, command):
+		if command[0] == "-t":
+			return (command[1], command[2:])
+		else:
+			return ("filter", command)
+
+	@classmethod
+	def command_chain(cls, command):
+		"""Returns the name of the chain a command operates on, prefixed by
+		its table (e.g., 'nat.PREROUTING')."""
+		(table, command) = cls.split_table(command)
+		return "%s.%s" % (table, command[1])
+
+	def generate_by_chain(self):
+		chains = { }
+		for command in self.generate():
+			chain = self.command_chain(command)
+			if chain not in chains:
+				chains[chain] = [ ]
+			chains[chain].append(command)
+		return chains
+
+	def generate_tc(self):
+		"""Yields tuples of the pseudo chain name (e.g., 'tc.eth0') and the tc
+		commands that set up the queueing of every device with QoS."""
+		qos = self._metadata.get("qos")
+		if qos is not None:
+			for device in qos.devices:
+				yield ("tc." + device, qos.device_commands(device))
+
+	def chain_hashes(self):
+		"""Returns the hash of the commands of every chain. The tc setup of a
+		device is treated like a chain so that it is diffed and applied
+		together with the ruleset."""
+		hashes = { }
+		for (chain, commands) in itertools.chain(self.generate_by_chain().items(), self.generate_tc()):
+			hashval = hashlib.md5()
+			for command in commands:
+				hashval.update(str(command).encode("utf-8"))
+			hashes[chain] = hashval.hexdigest()
+		return hashes
+
 	def write_script(self, f, verbose = False):
 		cle = CmdlineEscape()
 		print("#!/bin/bash", file = f)
 		print("# hash %s" % (self.hash()), file = f)
 		print("# firewall ruleset generated %s UTC by firewalld. DO NOT EDIT MANUALLY" % (datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")), file = f)
 		print(file = f)
+		for feed in self._metadata.get("feeds", [ ]):
+			print("# feed %s" % (feed.name), file = f)
+			for line in feed.script_commands():
+				print(line, file = f)
+			print(file = f)
+		for dynamic_set in self._metadata.get("dynamic_sets", [ ]):
+			print("# dynamic set %s" % (dynamic_set.name), file = f)
+			for line in dynamic_set.script_commands():
+				print(line, file = f)
+			print(file = f)
+		for fqdn_set in self._metadata.get("fqdn_sets", [ ]):
+			print("# fqdn set %s" % (fqdn_set.name), file = f)
+			for line in fqdn_set.script_commands():
+				print(line, file = f)
+			print(file = f)
+		qos = self._metadata.get("qos")
+		if qos is not None:
+			for device in qos.devices:
+				print("# qos %s" % (device), file = f)
+				for line in qos.script_commands(device):
+					print(line, file = f)
+				print(file = f)
 		for rules in self._rules:
 			print("# %s" % (rules.name), file = f)
 			for rule in rules:
@@ -142,16 +325,166 @@ class Ruleset():
 					rule.dump(prefix = "# ", file = f)
 				for command in rule.generate_commands():
 					command = [ "iptables" ] + command
-					print(cle.cmdline(command), file = f)
+					if command[-2] == "-N":
+						# User chain may already exist when the script is run
+						# again, flush it like the builtin chains then
+						print(cle.cmdline(command) + " 2>/dev/null", file = f)
+						print(cle.cmdline(command[:-2] + [ "-F", command[-1] ]), file = f)
+					else:
+						print(cle.cmdline(command), file = f)
 			print(file = f)
 
-	def apply(self):
+	@classmethod
+	def _restore_escape(cls, arg):
+		if (arg == "") or any(char in arg for char in " \t\"'#\\"):
+			return "\"%s\"" % (arg.replace("\\", "\\\\").replace("\"", "\\\""))
+		else:
+			return arg
+
+	def generate_restore(self):
+		"""Generates the ruleset in iptables-restore format. Commands are
+		grouped by table, within each table the order is retained. The result
+		is intended to be loaded with 'iptables-restore --noflush' so that
+		chains not mentioned in the ruleset remain untouched."""
+		tables = { }
+		for command in self.generate():
+			(table, command) = self.split_table(command)
+			if table not in tables:
+				tables[table] = ([ ], [ ])
+			(declarations, lines) = tables[table]
+			if command[0] == "-N":
+				# Declaring a user chain creates it or flushes it if it exists
+				declarations.append(":%s - [0:0]" % (command[1]))
+			else:
+				lines.append(" ".join(self._restore_escape(arg) for arg in command))
+		for (table, (declarations, lines)) in tables.items():
+			yield "*%s" % (table)
+			yield from declarations
+			yield from lines
+			yield "COMMIT"
+
+	def write_restore(self, f):
+		print("# hash %s" % (self.hash()), file = f)
+		for line in self.generate_restore():
+			print(line, file = f)
+
+	def _apply_shadowed(self, chain, commands):
+		"""Applies the commands of a chain without ever leaving it partially
+		populated: all rules are appended to a new versioned chain (e.g.,
+		INPUT_v1), a jump to it is inserted at the top of the original chain
+		and the old rules and old versions are removed, all in a single
+		'iptables-restore --noflush' transaction. Old rules are deleted by
+		their exact specification, so rules that other tools inserted in the
+		meantime are kept. The lowest free version is used, so that chains
+		alternate between _v0 and _v1 and their names never grow."""
+		(table, chain_name) = chain.split(".", maxsplit = 1)
+		shadow_prefix = chain_name + "_v"
+		versions = set()
+		old_rules = [ ]
+		chain_exists = False
+		listing = subprocess.check_output([ "iptables", "-t", table, "-S" ]).decode("utf-8")
+		for line in listing.split("\n"):
+			fields = line.split()
+			if len(fields) < 2:
+				continue
+			if (fields[0] == "-N") and fields[1].startswith(shadow_prefix) and fields[1][len(shadow_prefix):].isdigit():
+				versions.add(int(fields[1][len(shadow_prefix):]))
+			elif (fields[0] in [ "-N", "-P" ]) and (fields[1] == chain_name):
+				chain_exists = True
+			elif (fields[0] == "-A") and (fields[1] == chain_name):
+				old_rules.append("-D" + line.strip()[2:])
+		version = min(version for version in range(len(versions) + 1) if version not in versions)
+		shadow_chain = shadow_prefix + str(version)
+
+		declarations = [ ":%s - [0:0]" % (shadow_chain) ]
+		fill_commands = [ ]
+		switch_commands = [ ]
+		for command in commands:
+			(_, command) = self.split_table(command)
+			if command[0] == "-A":
+				fill_commands.append([ "-A", shadow_chain ] + command[2:])
+			elif command[0] == "-F":
+				# Old rules are removed after the switch instead
+				pass
+			elif command[0] == "-N":
+				# User chain, only needs to be created the first time;
+				# declaring an existing one would flush it
+				if not chain_exists:
+					declarations.insert(0, ":%s - [0:0]" % (command[1]))
+			else:
+				switch_commands.append(command)
+		switch_commands.append([ "-I", chain_name, "1", "-j", shadow_chain ])
+		lines = [ " ".join(self._restore_escape(arg) for arg in command) for command in fill_commands + switch_commands ]
+		lines += old_rules
+		for version in sorted(versions):
+			lines += [ "-F %s%d" % (shadow_prefix, version), "-X %s%d" % (shadow_prefix, version) ]
+
+		restore_data = "".join(line + "\n" for line in [ "*%s" % (table) ] + declarations + lines + [ "COMMIT" ]).encode("utf-8")
+		subprocess.run([ "iptables-restore", "--noflush" ], input = restore_data, check = True)
+		return len(declarations) + len(lines)
+
+	def _apply_tc(self, chains):
+		executed = 0
+		qos = self._metadata.get("qos")
+		if qos is not None:
+			for device in qos.devices:
+				if (chains is None) or (("tc." + device) in chains):
+					executed += qos.apply(device)
+		return executed
+
+	def apply(self, chains = None, shadow_chains = False):
+		"""Applies the ruleset. If chains is given, only commands that operate
+		on those chains (or tc setups of those devices) are executed. With
+		shadow_chains, every chain is switched over atomically to a completely
+		populated versioned chain instead of being flushed and refilled rule
+		by rule. Returns the number of iptables and tc commands that were
+		executed."""
+		executed = self._apply_tc(chains)
+		if shadow_chains:
+			# User chains need to be present before anything can jump to them
+			chain_commands = sorted(self.generate_by_chain().items(), key = lambda item: item[1][0][-2] != "-N")
+			for (chain, commands) in chain_commands:
+				if (chains is None) or (chain in chains):
+					executed += self._apply_shadowed(chain, commands)
+			return executed
+
 		for command in self.generate():
+			if (chains is not None) and (self.command_chain(command) not in chains):
+				continue
 			command = [ "iptables" ] + command
-			subprocess.check_call(command)
+			if command[-2] == "-N":
+				# Creating a user chain fails if it already exists, flush it then
+				if subprocess.call(command, stderr = subprocess.DEVNULL) != 0:
+					subprocess.check_call(command[:-2] + [ "-F", command[-1] ])
+					executed += 1
+			else:
+				subprocess.check_call(command)
+			executed += 1
+		return executed
 
 	def hash(self):
 		hashval = hashlib.md5()
 		for command in self.generate():
 			hashval.update(str(command).encode("utf-8"))
+		for (chain, commands) in self.generate_tc():
+			for command in commands:
+				hashval.update(str(command).encode("utf-8"))
 		return hashval.hexdigest()
+
+if __name__ == "__main__":
+	# Memory benchmark: 10000 JSON-level rules expanding to 100000 commands
+	import gc
+	import tracemalloc
+	tracemalloc.start()
+	ruleset = Ruleset({ })
+	for i in range(10000):
+		rules = Rules("rule %d" % (i))
+		rule = rules.new()
+		rule.add_fixed(("-A", "FORWARD"))
+		rule.add_group("proto", [ [ "-p", proto ] for proto in [ "tcp", "udp" ] ])
+		rule.add_group("src-net", [ [ "-s", "10.%d.%d.0/24" % (i % 256, net) ] for net in range(5) ])
+		rule.add_fixed(("-j", "ACCEPT"), ("-m", "comment", "--comment", "rule number %d" % (i % 100)))
+		ruleset.add_rules(rules)
+	gc.collect()
+	(current, peak) = tracemalloc.get_traced_memory()
+	print("%d commands, %.1f MiB retained, %.1f MiB peak, %d GC tracked objects" % (sum(1 for command in ruleset.generate()), current / 1024 / 1024, peak / 1024 / 1024, len(gc.get_objects())))
@@ -0,0 +1,154 @@
+#	firewalld - Linux firewall daemon with time-based capabilities
+#	Copyright (C) 2020-2021 Johannes Bauer
+#
+#	This file is part of firewalld.
+#
+#	firewalld is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	firewalld is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with firewalld; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import os
+import json
+import hashlib
+from pyipt.Exceptions import InvalidIncludeException
+
+class RulesetLoader():
+	"""Loads a ruleset JSON file together with all files it includes. A file
+	may contain a top-level list of files to include, which have the same
+	structure as the ruleset itself. Their feeds, hosts, interfaces, options,
+	sets and variables are merged (conflicting definitions are an error) and
+	the rules of their chains are appended, in the order in which the files
+	are listed, after the including file's own rules. Inside a chain's rule list,
+	an entry of the form { "include": "filename" } is replaced by the list
+	of rules contained in that file. Relative filenames are interpreted
+	relative to the including file.
+
+	Every file is parsed independently and its parsed content cached by
+	content hash, so that after an edit only the modified file is parsed
+	again."""
+	_MERGED_SECTIONS = [ "feeds", "hosts", "interfaces", "options", "qos", "sets", "variables" ]
+
+	def __init__(self, filename):
+		self._filename = filename
+		self._parse_cache = { }
+		self._filenames = [ ]
+		self._rule_origins = { }
+		self._changed = True
+
+	@property
+	def rule_origins(self):
+		"""For every chain of the last loaded ruleset, the list of (filename,
+		index) tuples that gives for each of its rules the file it was
+		defined in and its position in that file's rule list."""
+		return self._rule_origins
+
+	@property
+	def changed(self):
+		"""True if any file that the last loaded ruleset consisted of had to
+		be parsed anew, i.e., the ruleset source changed."""
+		return self._changed
+
+	@property
+	def filenames(self):
+		"""All files that the last loaded ruleset consisted of."""
+		return self._filenames
+
+	def _parse_file(self, filename, used_cache, including_filename = None):
+		try:
+			with open(filename, "rb") as f:
+				data = f.read()
+		except FileNotFoundError:
+			if including_filename is None:
+				raise
+			raise InvalidIncludeException("File %s included from %s does not exist." % (filename, including_filename))
+		digest = hashlib.md5(data).hexdigest()
+		if digest in self._parse_cache:
+			content = self._parse_cache[digest]
+		else:
+			try:
+				content = json.loads(data)
+			except json.decoder.JSONDecodeError as e:
+				raise InvalidIncludeException("Unable to parse %s: %s" % (filename, str(e)))
+			self._changed = True
+		used_cache[digest] = content
+		self._filenames.append(filename)
+		return content
+
+	@staticmethod
+	def _resolve_filename(including_filename, filename):
+		return os.path.join(os.path.dirname(including_filename), filename)
+
+	def _load_rules(self, filename, rules, used_cache, stack):
+		result = [ ]
+		for (index, rule) in enumerate(rules):
+			if isinstance(rule, dict) and ("include" in rule):
+				include_filename = self._resolve_filename(filename, rule["include"])
+				if include_filename in stack:
+					raise InvalidIncludeException("Circular inclusion of %s from %s." % (include_filename, filename))
+				included_rules = self._parse_file(include_filename, used_cache, filename)
+				if not isinstance(included_rules, list):
+					raise InvalidIncludeException("Rule file %s included from %s must contain a list of rules." % (include_filename, filename))
+				result += self._load_rules(include_filename, included_rules, used_cache, stack + [ include_filename ])
+			else:
+				result.append((rule, (filename, index)))
+		return result
+
+	@staticmethod
+	def _merge_value(section, key, merged, value, filename):
+		if (key in merged) and (merged[key] != value):
+			raise InvalidIncludeException("Conflicting definition of %s '%s' in %s." % (section, key, filename))
+		merged[key] = value
+
+	def _load(self, filename, source, used_cache, stack, including_filename = None):
+		content = self._parse_file(filename, used_cache, including_filename)
+		if not isinstance(content, dict):
+			raise InvalidIncludeException("Ruleset file %s must contain a JSON object." % (filename))
+
+		for section in self._MERGED_SECTIONS:
+			for (key, value) in content.get(section, { }).items():
+				self._merge_value(section, key, source.setdefault(section, { }), value, filename)
+
+		for (chain_name, chain_content) in content.get("chains", { }).items():
+			merged_chain = source.setdefault("chains", { }).setdefault(chain_name, { })
+			for (key, value) in chain_content.items():
+				if key == "rules":
+					merged_chain.setdefault("rules", [ ])
+					for (rule, origin) in self._load_rules(filename, value, used_cache, stack):
+						merged_chain["rules"].append(rule)
+						self._rule_origins.setdefault(chain_name, [ ]).append(origin)
+				else:
+					self._merge_value("chain %s option" % (chain_name), key, merged_chain, value, filename)
+
+		for include in content.get("include", [ ]):
+			include_filename = self._resolve_filename(filename, include)
+			if include_filename in stack:
+				raise InvalidIncludeException("Circular inclusion of %s from %s." % (include_filename, filename))
+			self._load(include_filename, source, used_cache, stack + [ include_filename ], filename)
+
+	def load(self):
+		"""Returns the merged ruleset source."""
+		source = { }
+		used_cache = { }
+		self._filenames = [ ]
+		self._rule_origins = { }
+		self._changed = False
+		self._load(self._filename, source, used_cache, [ self._filename ])
+		if set(used_cache) != set(self._parse_cache):
+			# Also catches removal of an include
+			self._changed = True
+		self._parse_cache = used_cache
+		source.setdefault("interfaces", { })
+		source.setdefault("chains", { })
+		return source
@@ -96,5 +96,9 @@ class Service():
 					services[service_name][result["proto"]] = int(result["port"])
 		return services
 
+	def ports(self):
+		"""Returns the set of all (protocol, port) tuples of the service."""
+		return set((proto, port) for (proto, port_map) in self._port_maps.items() for port in port_map.ports)
+
 	def __iter__(self):
 		yield from sorted(self._port_maps.items())
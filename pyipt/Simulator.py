@@ -0,0 +1,247 @@
+#	firewalld - Linux firewall daemon with time-based capabilities
+#	Copyright (C) 2020-2021 Johannes Bauer
+#
+#	This file is part of firewalld.
+#
+#	firewalld is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	firewalld is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with firewalld; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import sys
+import math
+import json
+import ipaddress
+import collections
+from pyipt.Rules import Ruleset
+from pyipt.Matches import Match, InterfaceMatch, AddressMatch, SetMatch, ProtocolMatch, PortMatch, ICMPTypeMatch, StateMatch, StringMatch, LimitMatch, HashLimitMatch, ConnLimitMatch, StatisticMatch, U32Match, Comment, Goto, Verdict
+
+class SimulatedRule():
+	"""A single compiled iptables rule whose Match objects are evaluated
+	against a packet in Python. Matches whose outcome cannot be determined
+	from a packet tuple alone (rate limits, connection limits, statistic and
+	u32 balancing) are assumed to match."""
+	_ICMP_TYPES = {
+		"echo-reply":		"0",
+		"echo-request":		"8",
+	}
+	_ASSUMED_MATCHES = ( LimitMatch, HashLimitMatch, ConnLimitMatch, StatisticMatch, U32Match, Comment )
+
+	def __init__(self, name, tokens, sets = None):
+		self._name = name
+		self._sets = sets or { }
+		self._matches = [ ]
+		self._target = None
+		self._goto = False
+		self._parse(tokens)
+
+	@property
+	def name(self):
+		return self._name
+
+	@property
+	def target(self):
+		return self._target
+
+	@property
+	def goto(self):
+		return self._goto
+
+	@staticmethod
+	def _match_interface(pattern, field):
+		def match(packet):
+			if packet.get(field) is None:
+				return False
+			if pattern.endswith("+"):
+				return packet[field].startswith(pattern[:-1])
+			return packet[field] == pattern
+		return match
+
+	@staticmethod
+	def _match_address(network, field):
+		network = ipaddress.ip_network(network, strict = False)
+		def match(packet):
+			return (packet.get(field) is not None) and (ipaddress.ip_address(packet[field]) in network)
+		return match
+
+	@staticmethod
+	def _match_proto(proto):
+		def match(packet):
+			return packet.get("proto") == proto
+		return match
+
+	@staticmethod
+	def _match_ports(spans, field):
+		def match(packet):
+			return (packet.get(field) is not None) and any(begin <= packet[field] <= end for (begin, end) in spans)
+		return match
+
+	@classmethod
+	def _match_icmp_type(cls, icmp_type):
+		icmp_type = cls._ICMP_TYPES.get(icmp_type, icmp_type)
+		def match(packet):
+			return cls._ICMP_TYPES.get(packet.get("icmp-type"), packet.get("icmp-type")) == icmp_type
+		return match
+
+	@staticmethod
+	def _match_states(states):
+		states = set(states)
+		def match(packet):
+			return len(states & packet["state"]) > 0
+		return match
+
+	@staticmethod
+	def _match_data(data):
+		needle = data.lower()
+		def match(packet):
+			return needle in bytes.fromhex(packet.get("payload", "")).lower()
+		return match
+
+	def _match_set(self, set_name, direction):
+		# Sets whose content is not known are considered empty
+		networks = self._sets.get(set_name, [ ])
+		field = "src" if (direction == "src") else "dst"
+		def match(packet):
+			return (packet.get(field) is not None) and any(ipaddress.ip_address(packet[field]) in network for network in networks)
+		return match
+
+	def _parse(self, tokens):
+		for token in tokens:
+			if isinstance(token, InterfaceMatch):
+				self._matches.append((token.negated, self._match_interface(token.name, token.direction)))
+			elif isinstance(token, AddressMatch):
+				self._matches.append((False, self._match_address(token.network, token.direction)))
+			elif isinstance(token, SetMatch):
+				self._matches.append((False, self._match_set(token.set_name, token.direction)))
+			elif isinstance(token, ProtocolMatch):
+				self._matches.append((False, self._match_proto(token.proto)))
+			elif isinstance(token, PortMatch):
+				self._matches.append((False, self._match_proto(token.proto)))
+				self._matches.append((False, self._match_ports(token.intervals, "sport" if (token.direction == "src") else "dport")))
+			elif isinstance(token, ICMPTypeMatch):
+				self._matches.append((False, self._match_proto("icmp")))
+				self._matches.append((False, self._match_icmp_type(token.icmp_type)))
+			elif isinstance(token, StateMatch):
+				self._matches.append((False, self._match_states(token.states)))
+				if token.orig_dport is not None:
+					self._matches.append((False, self._match_ports([ token.orig_dport ], "orig-dport")))
+			elif isinstance(token, StringMatch):
+				self._matches.append((False, self._match_data(token.data)))
+			elif isinstance(token, Verdict):
+				self._target = token.target
+			elif isinstance(token, Goto):
+				self._target = token.chain
+				self._goto = True
+			elif isinstance(token, self._ASSUMED_MATCHES):
+				pass
+			else:
+				raise NotImplementedError(token)
+
+	def matches(self, packet):
+		return all(negate != match(packet) for (negate, match) in self._matches)
+
+class Simulator():
+	"""Evaluates a compiled Ruleset against packet tuples without involving
+	the kernel. For every packet, the verdict and the JSON rule which decided
+	it are determined, as well as how many rules had to be evaluated per
+	chain. Packets are dictionaries with the keys 'chain' (e.g., 'forward' or
+	'nat.prerouting'), 'in', 'out', 'src', 'dst', 'proto', 'sport', 'dport',
+	'icmp-type', 'state' (defaults to NEW) and optionally 'payload' (hex)
+	and 'expect' (the expected verdict)."""
+	_TERMINAL_TARGETS = set([ "ACCEPT", "DROP", "REJECT", "DNAT", "SNAT", "MASQUERADE", "REDIRECT" ])
+
+	def __init__(self, ruleset):
+		self._chains = collections.defaultdict(list)
+		self._policies = { }
+		sets = { feed.ipset.name: [ ipaddress.ip_network(network) for network in feed.networks() ] for feed in ruleset.metadata.get("feeds", [ ]) }
+		for rules in ruleset.rules:
+			for rule in rules:
+				for tokens in rule.generate_ir():
+					# The command and chain are given as leading raw arguments
+					command = [ token for token in tokens if not isinstance(token, Match) ]
+					(table, command) = Ruleset.split_table(command)
+					chain = "%s.%s" % (table, command[1])
+					if command[0] == "-A":
+						self._chains[chain].append(SimulatedRule(rules.name, [ token for token in tokens if isinstance(token, Match) ], sets))
+					elif command[0] == "-P":
+						self._policies[chain] = command[2]
+
+	@staticmethod
+	def _chain_name(name):
+		if "." in name:
+			(table, chain) = name.split(".", maxsplit = 1)
+		else:
+			(table, chain) = ("filter", name)
+		return "%s.%s" % (table, chain.upper())
+
+	def _traverse(self, chain, packet, evaluated):
+		table = chain.split(".", maxsplit = 1)[0]
+		for rule in self._chains.get(chain, [ ]):
+			evaluated[chain] += 1
+			if (rule.target is None) or (not rule.matches(packet)):
+				continue
+			if rule.target in self._TERMINAL_TARGETS:
+				return (rule.target, rule.name, chain)
+			elif rule.target == "RETURN":
+				return None
+			subchain = "%s.%s" % (table, rule.target)
+			if subchain in self._chains:
+				result = self._traverse(subchain, packet, evaluated)
+				if (result is not None) or rule.goto:
+					return result
+			# Otherwise non-terminating target (e.g., LOG), continue
+		return None
+
+	def simulate(self, packet):
+		packet = dict(packet)
+		state = packet.get("state", "NEW")
+		packet["state"] = set(state.upper().split(",")) if isinstance(state, str) else set(state)
+		chain = self._chain_name(packet["chain"])
+		evaluated = collections.Counter()
+		result = self._traverse(chain, packet, evaluated)
+		if result is None:
+			result = (self._policies.get(chain, "ACCEPT"), "policy", chain)
+		return {
+			"verdict":		result[0],
+			"rule":			result[1],
+			"chain":		result[2],
+			"evaluated":	evaluated,
+		}
+
+	def simulate_trace(self, packets, file = sys.stdout):
+		"""Simulates all packets and prints a report. Returns the number of
+		packets whose verdict differs from the expected one."""
+		mismatches = 0
+		evaluated_per_chain = collections.defaultdict(list)
+		for (pktno, packet) in enumerate(packets, 1):
+			result = self.simulate(packet)
+			for (chain, count) in result["evaluated"].items():
+				evaluated_per_chain[chain].append(count)
+			line = "%d: %s by '%s' in %s after %d rules" % (pktno, result["verdict"], result["rule"], result["chain"], sum(result["evaluated"].values()))
+			if ("expect" in packet) and (packet["expect"].upper() != result["verdict"]):
+				line += " -- MISMATCH, expected %s" % (packet["expect"].upper())
+				mismatches += 1
+			print(line, file = file)
+
+		print(file = file)
+		for (chain, counts) in sorted(evaluated_per_chain.items()):
+			counts.sort()
+			p99 = counts[math.ceil(0.99 * len(counts)) - 1]
+			print("%-20s %d packets, %.1f rules evaluated on average, p99 %d" % (chain, len(counts), sum(counts) / len(counts), p99), file = file)
+		return mismatches
+
+	def simulate_trace_file(self, filename, file = sys.stdout):
+		with open(filename) as f:
+			packets = json.load(f)
+		return self.simulate_trace(packets, file = file)
@@ -79,6 +79,19 @@ class TimeWindow():
 					return True
 		return False
 
+	def boundaries(self):
+		"""Returns the seconds of the week (starting Monday 00:00) at which
+		the time window might open or close. Since both ends of a range are
+		inclusive, the second after every range end is a candidate as well."""
+		seconds = set()
+		for (daytime_match, from_sec, to_sec) in self._second_ranges:
+			for sec in [ from_sec, from_sec + 1, to_sec, to_sec + 1 ]:
+				if daytime_match:
+					seconds |= set(((86400 * day) + sec) % (7 * 86400) for day in range(7))
+				else:
+					seconds.add(sec % (7 * 86400))
+		return seconds
+
 	def satisfied(self, timestamp):
 		daytime_sec = (timestamp.hour * 3600) + (timestamp.minute * 60) + timestamp.second
 		weekday_sec = (86400 * timestamp.weekday()) + daytime_sec
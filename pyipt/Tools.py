@@ -19,6 +19,19 @@
 #
 #	Johannes Bauer <JohannesBauer@gmx.de>
 
+import os
+import contextlib
+
 def multisplit(text, split_char = ","):
 	values = [ component.strip("\r\n\t ") for component in text.split(split_char) ]
 	return values
+
+@contextlib.contextmanager
+def atomic_write(filename):
+	"""Opens a temporary file for writing that replaces the given file once
+	it was written completely, so that readers never see a partially
+	written file."""
+	tmp_filename = filename + ".tmp"
+	with open(tmp_filename, "w") as f:
+		yield f
+	os.rename(tmp_filename, filename)
@@ -0,0 +1,179 @@
+#	firewalld - Linux firewall daemon with time-based capabilities
+#	Copyright (C) 2020-2021 Johannes Bauer
+#
+#	This file is part of firewalld.
+#
+#	firewalld is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	firewalld is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with firewalld; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import re
+import subprocess
+from pyipt.Exceptions import InvalidQoSException, UnknownInterfaceException
+
+class TrafficControl():
+	"""Generates the tc queueing setup of the 'qos' section. Every interface
+	given there gets an HTB root qdisc limited to the interface rate with one
+	class per traffic class and an fq_codel leaf qdisc in each of them.
+	Packets are put into a class either by a 'classify' rule in the mangle
+	table or by a firewall mark which is mapped to a class by a tc filter.
+
+	Class IDs are assigned by class name across all interfaces, so a class
+	has the same ID on every interface it is defined on and a classify rule
+	does not need to know the egress interface."""
+	_RATE_RE = re.compile(r"\d+(\.\d+)?(bit|kbit|mbit|gbit)")
+	_HANDLE = 1
+	_FIRST_MINOR = 0x10
+	_KNOWN_INTERFACE_KEYS = set([ "rate", "default", "classes" ])
+	_KNOWN_CLASS_KEYS = set([ "rate", "ceil", "prio", "mark" ])
+
+	def __init__(self, qos_definition, config):
+		self._devices = { }
+		for (interface, definition) in sorted(qos_definition.items()):
+			if interface in config["interfaces-rev"]:
+				device = config["interfaces-rev"][interface]
+			elif interface in config["interfaces"]:
+				device = interface
+			else:
+				raise UnknownInterfaceException("Unknown interface in qos section: %s" % (interface))
+			if device.endswith("+"):
+				raise InvalidQoSException("qos can only be set up for a single device, not for interface pattern %s (%s)." % (device, interface))
+			self._devices[device] = self._check_interface(interface, definition)
+		class_names = sorted(set(class_name for definition in self._devices.values() for class_name in definition["classes"]))
+		self._class_minors = { class_name: self._FIRST_MINOR + index for (index, class_name) in enumerate(class_names) }
+
+	def _check_rate(self, rate, where):
+		if (not isinstance(rate, str)) or (self._RATE_RE.fullmatch(rate) is None):
+			raise InvalidQoSException("Rate of %s must be given with a unit (e.g., '20mbit'): %s" % (where, str(rate)))
+		return rate
+
+	def _check_interface(self, interface, definition):
+		unknown_keys = set(definition) - self._KNOWN_INTERFACE_KEYS
+		if len(unknown_keys) > 0:
+			raise InvalidQoSException("Unknown option(s) %s for qos of interface %s." % (", ".join(sorted(unknown_keys)), interface))
+		self._check_rate(definition.get("rate"), "interface %s" % (interface))
+		if len(definition.get("classes", { })) == 0:
+			raise InvalidQoSException("qos of interface %s defines no classes." % (interface))
+		if definition.get("default") not in definition["classes"]:
+			raise InvalidQoSException("qos of interface %s needs a 'default' class, one of: %s" % (interface, ", ".join(sorted(definition["classes"]))))
+		for (class_name, class_definition) in definition["classes"].items():
+			where = "class %s of interface %s" % (class_name, interface)
+			unknown_keys = set(class_definition) - self._KNOWN_CLASS_KEYS
+			if len(unknown_keys) > 0:
+				raise InvalidQoSException("Unknown option(s) %s for qos %s." % (", ".join(sorted(unknown_keys)), where))
+			self._check_rate(class_definition.get("rate"), where)
+			if "ceil" in class_definition:
+				self._check_rate(class_definition["ceil"], where)
+			if not isinstance(class_definition.get("prio", 0), int):
+				raise InvalidQoSException("Priority of qos %s must be an integer." % (where))
+			if not isinstance(class_definition.get("mark", 0), int):
+				raise InvalidQoSException("Mark of qos %s must be an integer." % (where))
+		return definition
+
+	@property
+	def devices(self):
+		return list(self._devices)
+
+	def classid(self, class_name):
+		if class_name not in self._class_minors:
+			raise InvalidQoSException("Unknown qos class: %s" % (class_name))
+		return "%x:%x" % (self._HANDLE, self._class_minors[class_name])
+
+	def device_commands(self, device):
+		"""Returns all tc commands that set up the queueing of a device. They
+		only replace what is already set up, so applying them to a device
+		with a previous setup neither drops queued packets nor falls back to
+		the default qdisc in between."""
+		definition = self._devices[device]
+		root = "%x:" % (self._HANDLE)
+		parent = "%x:1" % (self._HANDLE)
+		commands = [
+			[ "tc", "qdisc", "replace", "dev", device, "root", "handle", root, "htb", "default", "%x" % (self._class_minors[definition["default"]]) ],
+			[ "tc", "class", "replace", "dev", device, "parent", root, "classid", parent, "htb", "rate", definition["rate"], "ceil", definition["rate"] ],
+		]
+		for (class_name, class_definition) in sorted(definition["classes"].items()):
+			classid = self.classid(class_name)
+			minor = "%x:" % (self._class_minors[class_name])
+			commands.append([ "tc", "class", "replace", "dev", device, "parent", parent, "classid", classid, "htb", "rate", class_definition["rate"], "ceil", class_definition.get("ceil", definition["rate"]), "prio", str(class_definition.get("prio", 0)) ])
+			commands.append([ "tc", "qdisc", "replace", "dev", device, "parent", classid, "handle", minor, "fq_codel" ])
+			if "mark" in class_definition:
+				commands.append([ "tc", "filter", "replace", "dev", device, "parent", root, "protocol", "all", "prio", "1", "handle", str(class_definition["mark"]), "fw", "classid", classid ])
+		return commands
+
+	@staticmethod
+	def _show(arguments):
+		# Fails if nothing is set up on the device yet
+		result = subprocess.run([ "tc" ] + arguments, stdout = subprocess.PIPE, stderr = subprocess.DEVNULL)
+		return result.stdout.decode("ascii") if (result.returncode == 0) else ""
+
+	def _stale_commands(self, device):
+		"""Returns the tc commands that delete the filters and classes which
+		are set up on the device, but no longer defined, as a tuple. Filters
+		need to be deleted before anything else, classes only after the
+		remaining filters were redirected to their new classes."""
+		definition = self._devices[device]
+		root = "%x:" % (self._HANDLE)
+		classids = set([ "%x:1" % (self._HANDLE) ]) | set(self.classid(class_name) for class_name in definition["classes"])
+		marks = set(class_definition["mark"] for class_definition in definition["classes"].values() if "mark" in class_definition)
+		filter_commands = [ ]
+		output = self._show([ "filter", "show", "dev", device, "parent", root ])
+		for line in output.split("\n"):
+			fields = line.split()
+			if ("fw" in fields) and ("handle" in fields) and ("pref" in fields) and (fields.index("handle") + 1 < len(fields)):
+				(prio, handle) = (fields[fields.index("pref") + 1], int(fields[fields.index("handle") + 1], 0))
+				if handle not in marks:
+					filter_commands.append([ "tc", "filter", "del", "dev", device, "parent", root, "protocol", "all", "prio", prio, "handle", str(handle), "fw" ])
+		class_commands = [ ]
+		output = self._show([ "class", "show", "dev", device ])
+		for line in output.split("\n"):
+			fields = line.split()
+			if (len(fields) >= 3) and (fields[:2] == [ "class", "htb" ]) and fields[2].startswith(root) and (fields[2] not in classids):
+				class_commands.append([ "tc", "class", "del", "dev", device, "classid", fields[2] ])
+		return (filter_commands, class_commands)
+
+	def apply(self, device):
+		"""Sets up the queueing of a device and returns the number of tc
+		commands that were executed. Classes and filters of a previous setup
+		which are no longer defined are deleted."""
+		(filter_commands, class_commands) = self._stale_commands(device)
+		commands = filter_commands + self.device_commands(device) + class_commands
+		for command in commands:
+			subprocess.check_call(command)
+		return len(commands)
+
+	def script_commands(self, device):
+		"""Returns the commands of the device setup for a firewall script.
+		Unlike apply(), they leave classes and filters of a previous setup
+		that are no longer defined in place."""
+		return [ " ".join(command) for command in self.device_commands(device) ]
+
+if __name__ == "__main__":
+	config = {
+		"interfaces":		{ "eth1": "external" },
+		"interfaces-rev":	{ "external": "eth1" },
+	}
+	tc = TrafficControl({
+		"external": {
+			"rate":		"20mbit",
+			"default":	"bulk",
+			"classes": {
+				"interactive":	{ "rate": "4mbit", "prio": 0 },
+				"bulk":			{ "rate": "16mbit", "prio": 1, "mark": 2 },
+			},
+		},
+	}, config)
+	for line in tc.script_commands("eth1"):
+		print(line)
+	print("interactive -> %s" % (tc.classid("interactive")))
@@ -21,43 +21,237 @@
 #	Johannes Bauer <JohannesBauer@gmx.de>
 
 import sys
-import time
-import datetime
 from pyipt.FriendlyArgumentParser import FriendlyArgumentParser
-from pyipt.Firewall import Firewall
 
 parser = FriendlyArgumentParser(description = "Linux firewall daemon.")
-parser.add_argument("-m", "--mode", choices = [ "script", "oneshot", "daemonize" ], default = "script", help = "Mode in which firewalld operates. Can be one of %(choices)s, defaults to %(default)s.")
+parser.add_argument("-m", "--mode", choices = [ "script", "oneshot", "daemonize", "simulate", "schedule", "ban", "unban", "list-bans", "dns-snoop" ], default = "script", help = "Mode in which firewalld operates. Can be one of %(choices)s, defaults to %(default)s. 'dns-snoop' reads DNS responses from the NFLOG group given by the dns_snoop option and adds the addresses of domain names used in rules to their sets, which expire with the TTL of the answer; the rule logging the responses must be limited to the trusted resolver with 'src-host'. 'schedule' previews at which times during the next week time windows change the ruleset and which chains and rules are affected. 'ban' and 'unban' add an address to or remove it from a dynamic set directly in the kernel, without regenerating the ruleset.")
 parser.add_argument("--iteration-time", metavar = "secs", type = float, default = 60, help = "For daemonized mode, gives the iteration time in seconds. Defaults to %(default).0f seconds.")
+parser.add_argument("--debounce-time", metavar = "secs", type = float, default = 1, help = "For daemonized mode, the ruleset is regenerated as soon as the ruleset file or one of the files it depends on (/etc/services, /etc/hosts, mocked interfaces) changes. Regeneration happens once no further change was seen for this time. Defaults to %(default).0f second.")
+parser.add_argument("--drift-check-time", metavar = "secs", type = float, default = 600, help = "For daemonized mode, gives the interval in seconds in which the live kernel ruleset is checked for modifications by other tools. Defaults to %(default).0f seconds.")
+parser.add_argument("--precompute", action = "store_true", help = "For daemonized mode, generate the ruleset of the next time window transition in advance so that at the transition it only needs to be applied.")
+parser.add_argument("--shadow-chains", action = "store_true", help = "When applying a ruleset, fill each chain into a new versioned chain first and then switch over to it with a single jump. Avoids the window in which a chain is flushed but not yet refilled.")
 parser.add_argument("--ignore-errors", action = "store_true", help = "If rules cannot be resolved, e.g., because an interface does not exist, continue. This can be dangerous.")
+parser.add_argument("--state-dir", metavar = "dirname", type = str, help = "Directory in which persistent state (e.g., last known good DNS answers or the last applied ruleset) is kept. When given, the last applied ruleset is restored on startup if its inputs are unchanged and the first ruleset is generated from the persisted DNS answers, which are refreshed afterwards. Also, only chains whose live content differs from what was last applied are flushed and refilled on startup. Without a state directory, nothing is known about what was applied before, so every (re)start flushes and refills all chains. By default, no state is kept.")
+parser.add_argument("--metrics-file", metavar = "filename", type = str, help = "For oneshot and daemonized mode, write metrics about generation and application of rulesets to this file in Prometheus text format after every iteration, e.g., for the node exporter's textfile collector.")
+parser.add_argument("--rule-table", metavar = "filename", type = str, help = "Kernel rules carry a short ID of the JSON rule they were generated from as their comment and in their log prefix. Write the table mapping these IDs to ruleset file, chain, index and comment of the rule to this file. For oneshot and daemonized mode, it is written after every application and defaults to rule_table.json in the state directory.")
 parser.add_argument("--dump-scripts", metavar = "dirname", type = str, help = "Dump all rulesets into a file; useful for debugging what is changing between versions.")
+parser.add_argument("--trace", metavar = "file", type = str, help = "For simulation mode, JSON file containing a list of packets to evaluate against the generated ruleset. For DNS snooping mode, JSON file containing a list of recorded IP packets (hex encoded) which are processed instead of listening to NFLOG; the sets are then left untouched.")
+parser.add_argument("--set", metavar = "name", type = str, help = "For ban modes, name of the dynamic set that is modified.")
+parser.add_argument("--address", metavar = "addr", type = str, help = "For ban and unban modes, the address or network to ban or unban.")
+parser.add_argument("--timeout", metavar = "secs", type = int, help = "For ban mode, time after which the ban expires in the kernel. Defaults to the timeout of the set.")
 parser.add_argument("-o", "--output", metavar = "file", type = str, default = "firewall.sh", help = "When writing a script, gives the output filename. Can be '-' for stdout. Defaults to %(default)s.")
 parser.add_argument("-v", "--verbose", action = "count", default = 0, help = "Increases verbosity. Can be specified multiple times to increase.")
 parser.add_argument("ruleset", metavar = "ruleset", type = str, help = "Ruleset JSON file to load.")
 args = parser.parse_args(sys.argv[1:])
 
+if args.mode in [ "ban", "unban", "list-bans" ]:
+	# Only the set definitions are needed, the ruleset is not generated
+	from pyipt.RulesetLoader import RulesetLoader
+	from pyipt.DynamicSet import DynamicSet
+	sets = RulesetLoader(args.ruleset).load().get("sets", { })
+	if args.set not in sets:
+		parser.error("ban modes require a dynamic set (--set), one of: %s" % (", ".join(sorted(sets))))
+	dynamic_set = DynamicSet(args.set, sets[args.set])
+	if args.mode == "list-bans":
+		for (address, timeout) in sorted(dynamic_set.entries().items()):
+			print("%-20s %s" % (address, "permanent" if (timeout is None) else "expires in %d secs" % (timeout)))
+		sys.exit(0)
+	if args.address is None:
+		parser.error("ban and unban modes require an address (--address)")
+	if args.mode == "ban":
+		dynamic_set.add(args.address, timeout = args.timeout)
+	else:
+		dynamic_set.delete(args.address)
+	sys.exit(0)
+
+if args.mode == "dns-snoop":
+	# Only the domain names referred to by rules are needed
+	import json
+	from pyipt.RulesetLoader import RulesetLoader
+	from pyipt.FqdnSet import FqdnSet
+	from pyipt.DNSSnooper import DNSSnooper
+	from pyipt.Exceptions import InvalidFqdnException
+	source = RulesetLoader(args.ruleset).load()
+	try:
+		options = FqdnSet.snoop_options(source)
+	except InvalidFqdnException as e:
+		parser.error(str(e))
+	fqdn_sets = [ FqdnSet(fqdn, options["max_ttl"]) for fqdn in FqdnSet.collect(source) ]
+	snooper = DNSSnooper(fqdn_sets, min_ttl = options["min_ttl"], max_ttl = options["max_ttl"])
+	if args.trace is not None:
+		with open(args.trace) as f:
+			packets = [ bytes.fromhex(packet) for packet in json.load(f) ]
+		for (fqdn_set, address, timeout) in snooper.updates(packets):
+			print("%s %s timeout %d" % (fqdn_set.fqdn, address, timeout))
+		sys.exit(0)
+	from pyipt.NFLogSocket import NFLogSocket
+	for fqdn_set in fqdn_sets:
+		fqdn_set.ensure()
+	for (fqdn_set, address, timeout) in snooper.updates(NFLogSocket(options["group"])):
+		fqdn_set.add(address, timeout = timeout)
+		if args.verbose >= 1:
+			print("%s %s timeout %d" % (fqdn_set.fqdn, address, timeout), file = sys.stderr)
+	# Snooping never generates or applies a ruleset, even when the socket closes
+	sys.exit(0)
+
+boot_snapshot = None
+boot_hash = None
+if (args.state_dir is not None) and (args.mode in [ "oneshot", "daemonize" ]):
+	# Restore the previously applied ruleset before importing the rest of
+	# pyipt and performing the (potentially slow) ruleset generation.
+	from pyipt.BootSnapshot import BootSnapshot
+	boot_snapshot = BootSnapshot(args.state_dir + "/boot_snapshot.json", args.ruleset)
+	boot_hash = boot_snapshot.apply()
+
+import time
+import datetime
+import subprocess
+from pyipt.Firewall import Firewall
+from pyipt.Reconciler import Reconciler, KernelState
+from pyipt.Exceptions import InvalidFeedException
+
 fw = Firewall(args.ruleset, args)
 ruleset = fw.generate()
+rule_table_filename = args.rule_table
+if (rule_table_filename is None) and (args.state_dir is not None):
+	rule_table_filename = args.state_dir + "/rule_table.json"
 if args.mode == "script":
+	if args.rule_table is not None:
+		ruleset.metadata["rule_table"].write(args.rule_table)
 	if args.output == "-":
 		ruleset.write_script(sys.stdout, verbose = (args.verbose >= 1))
 	else:
 		with open(args.output, "w") as f:
 			ruleset.write_script(f, verbose = (args.verbose >= 1))
 	sys.exit(0)
+elif args.mode == "schedule":
+	now = datetime.datetime.now()
+	previous = ruleset
+	for transition in fw.transitions(now, now + datetime.timedelta(weeks = 1)):
+		upcoming = fw.generate(now = transition)
+		(previous_hashes, upcoming_hashes) = (previous.chain_hashes(), upcoming.chain_hashes())
+		chains = [ chain for chain in upcoming_hashes if previous_hashes.get(chain) != upcoming_hashes[chain] ]
+		chains += [ chain for chain in previous_hashes if chain not in upcoming_hashes ]
+		print("%s  %s  hash %s, changed chains %s" % (transition.strftime("%a"), transition.strftime("%Y-%m-%d %H:%M:%S"), upcoming.hash(), ", ".join(chains) or "none"))
+		(previous_names, upcoming_names) = (set(rules.name for rules in previous.rules), set(rules.name for rules in upcoming.rules))
+		for name in sorted(upcoming_names - previous_names):
+			print("    + %s" % (name))
+		for name in sorted(previous_names - upcoming_names):
+			print("    - %s" % (name))
+		previous = upcoming
+	sys.exit(0)
+elif args.mode == "simulate":
+	from pyipt.Simulator import Simulator
+	if args.trace is None:
+		parser.error("simulation mode requires a packet trace (--trace)")
+	mismatches = Simulator(ruleset).simulate_trace_file(args.trace)
+	sys.exit(1 if (mismatches > 0) else 0)
 elif (args.mode == "oneshot") or (args.mode == "daemonize"):
-	last_hash = None
+	last_hash = boot_hash
+	reconciler = Reconciler((args.state_dir + "/applied_chains.json") if (args.state_dir is not None) else None)
+	# The live kernel state is only read once on startup, afterwards it is
+	# assumed that it holds what was last applied.
+	kernel_state = KernelState.read()
+	if kernel_state is None:
+		reconciler.forget()
+	elif args.state_dir is None:
+		print("No state directory given, the live ruleset cannot be compared to what was applied before; applying all chains.", file = sys.stderr)
+	if (boot_hash is not None) and (boot_hash == ruleset.hash()):
+		# The boot snapshot restored exactly this ruleset, which is therefore
+		# not applied again; record the layout it left in the kernel so that
+		# drift is detected against it.
+		reconciler.record(ruleset)
+	last_drift_check = time.time()
+	watcher = None
+	if args.mode == "daemonize":
+		from pyipt.FileWatcher import FileWatcher
+		watcher = FileWatcher(fw.input_paths, debounce_time = args.debounce_time)
+	next_transition = None
+	upcoming = None
 	while True:
+		# Sets need to exist before rules can refer to them
+		for dynamic_set in fw.dynamic_sets + fw.fqdn_sets:
+			try:
+				dynamic_set.ensure()
+			except subprocess.CalledProcessError as e:
+				print("Warning: Unable to create ipset %s: %s" % (dynamic_set.ipset.name, str(e)), file = sys.stderr)
+		for feed in fw.feeds:
+			try:
+				changes = feed.sync()
+			except InvalidFeedException as e:
+				print("Warning: Keeping previous content of ipset %s: %s" % (feed.ipset.name, str(e)), file = sys.stderr)
+				continue
+			except subprocess.CalledProcessError as e:
+				print("Warning: Unable to update ipset %s of feed %s: %s" % (feed.ipset.name, feed.name, str(e)), file = sys.stderr)
+				continue
+			if changes is not None:
+				print("Updated ipset %s of feed %s: %d entries added, %d removed." % (feed.ipset.name, feed.name, changes[0], changes[1]), file = sys.stderr)
 		current_hash = ruleset.hash()
 		if current_hash != last_hash:
-			print("Applying ruleset (old hash %s new hash %s)." % (last_hash, current_hash), file = sys.stderr)
-			if args.dump_scripts is not None:
-				dump_filename = args.dump_scripts + "/" + datetime.datetime.now().strftime("%Y_%m_%d_%H_%M_%S") + "_" + current_hash + ".sh"
-				with open(dump_filename, "w") as f:
-					ruleset.write_script(f, verbose = True)
-			ruleset.apply()
+			chains = reconciler.differing_chains(ruleset, kernel_state)
+			kernel_state = None
+			if len(chains) == 0:
+				print("Live ruleset already matches generated ruleset (hash %s), not applying." % (current_hash), file = sys.stderr)
+			else:
+				if last_hash is None:
+					reasons = [ "startup" ]
+				else:
+					reasons = fw.changed_inputs or [ "unknown" ]
+				print("Applying ruleset (old hash %s new hash %s, changed %s) to chains %s." % (last_hash, current_hash, ", ".join(reasons), ", ".join(chains)), file = sys.stderr)
+				if args.dump_scripts is not None:
+					dump_filename = args.dump_scripts + "/" + datetime.datetime.now().strftime("%Y_%m_%d_%H_%M_%S") + "_" + current_hash + ".sh"
+					with open(dump_filename, "w") as f:
+						ruleset.write_script(f, verbose = True)
+				with fw.metrics.time("firewalld_apply_seconds"):
+					executed_commands = ruleset.apply(chains, shadow_chains = args.shadow_chains)
+				fw.metrics.inc("firewalld_apply_commands_total", executed_commands)
+				for reason in reasons:
+					fw.metrics.inc("firewalld_reapply_total", reason = reason)
+				fw.metrics.set("firewalld_last_apply_timestamp_seconds", time.time())
+				reconciler.record(ruleset)
+				if rule_table_filename is not None:
+					ruleset.metadata["rule_table"].write(rule_table_filename)
+				if boot_snapshot is not None:
+					boot_snapshot.save(ruleset)
 			last_hash = current_hash
-		if args.mode == "oneshot":
+		if args.mode == "daemonize":
+			now = datetime.datetime.now()
+			transitions = fw.transitions(now, now + datetime.timedelta(weeks = 1))
+			if (len(transitions) == 0) or (transitions[0] != next_transition):
+				upcoming = None
+			next_transition = transitions[0] if (len(transitions) > 0) else None
+			# Only precomputed once per transition and again after the current
+			# ruleset was regenerated
+			if args.precompute and (next_transition is not None) and (upcoming is None):
+				upcoming = fw.generate(now = next_transition, precompute = True)
+		if (args.mode == "daemonize") and (time.time() - last_drift_check >= args.drift_check_time):
+			last_drift_check = time.time()
+			drifted_chains = reconciler.drifted_chains()
+			if len(drifted_chains) > 0:
+				print("Warning: Live ruleset was modified outside of firewalld in chains %s." % (", ".join(drifted_chains)), file = sys.stderr)
+		if args.metrics_file is not None:
+			fw.metrics.update_resident_memory()
+			fw.metrics.write(args.metrics_file)
+		if fw.resolver.refresh_pending:
+			# Ruleset was generated from the persisted DNS answers, refresh them
+			# and reapply if any of them changed.
+			fw.resolver.start_refresh()
+			fw.resolver.wait_refreshed(None if (args.mode == "oneshot") else args.iteration_time)
+		elif args.mode == "oneshot":
 			sys.exit(0)
-		time.sleep(args.iteration_time)
+		else:
+			timeout = args.iteration_time
+			if next_transition is not None:
+				timeout = min(timeout, max(0, (next_transition - datetime.datetime.now()).total_seconds()))
+			changed_paths = watcher.wait(timeout)
+			if len(changed_paths) > 0:
+				print("Regenerating ruleset, changed: %s" % (", ".join(changed_paths)), file = sys.stderr)
+			elif (upcoming is not None) and (datetime.datetime.now() >= next_transition):
+				# Precomputed ruleset is still valid since no input changed
+				fw.adopt_precomputed(upcoming)
+				(ruleset, upcoming) = (upcoming, None)
+				continue
 		ruleset = fw.generate()
+		upcoming = None
+		if watcher is not None:
+			watcher.update(fw.input_paths)
@@ -0,0 +1,70 @@
+#	firewalld - Linux firewall daemon with time-based capabilities
+#	Copyright (C) 2020-2021 Johannes Bauer
+#
+#	This file is part of firewalld.
+#
+#	firewalld is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	firewalld is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with firewalld; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import os
+import json
+import unittest
+from pyipt.FqdnSet import FqdnSet
+from pyipt.DNSSnooper import DNSSnooper
+from pyipt.Exceptions import InvalidFqdnException
+
+class DNSSnooperTests(unittest.TestCase):
+	_FIXTURE_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+
+	def _packets(self, name):
+		# Recorded packets in the format that dns-snoop mode replays (--trace)
+		with open(os.path.join(self._FIXTURE_DIR, name + ".json")) as f:
+			return [ bytes.fromhex(packet) for packet in json.load(f) ]
+
+	def _updates(self, fixture, fqdns):
+		snooper = DNSSnooper([ FqdnSet(fqdn, 86400) for fqdn in fqdns ], min_ttl = 60, max_ttl = 3600)
+		return [ (fqdn_set.fqdn, address, timeout) for (fqdn_set, address, timeout) in snooper.updates(self._packets(fixture)) ]
+
+	def test_cname_chain(self):
+		# www.reddit.com CNAME reddit.map.fastly.net (TTL 3600), two A records
+		# of the target with TTL 30, which is raised to min_ttl
+		self.assertEqual(self._updates("dns_reddit_cname", [ "www.reddit.com", "*.fastly.net" ]), [
+			("*.fastly.net", "151.101.128.193", 60),
+			("*.fastly.net", "151.101.64.193", 60),
+			("www.reddit.com", "151.101.128.193", 60),
+			("www.reddit.com", "151.101.64.193", 60),
+		])
+
+	def test_unmatched_fqdn(self):
+		self.assertEqual(self._updates("dns_reddit_cname", [ "reddit.com" ]), [ ])
+
+	def test_unasked_answer_ignored(self):
+		# Question for evil.example, but the answer section carries
+		# www.reddit.com A 6.6.6.6 with a TTL of 3600
+		self.assertEqual(self._updates("dns_unasked_answer", [ "www.reddit.com", "evil.example" ]), [ ])
+
+	def test_snoop_rule_requires_resolver(self):
+		config = {
+			"options": { "dns_snoop": { "group": 53 } },
+			"chains": { "input": { "rules": [ { "action": "log", "nflog": { "group": 53 }, "src-service": "dns/udp" } ] } },
+		}
+		with self.assertRaises(InvalidFqdnException):
+			FqdnSet.snoop_options(config)
+		config["chains"]["input"]["rules"][0]["src-host"] = "192.168.1.1"
+		self.assertEqual(FqdnSet.snoop_options(config)["group"], 53)
+
+if __name__ == "__main__":
+	unittest.main()
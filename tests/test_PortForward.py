@@ -0,0 +1,65 @@
+#	firewalld - Linux firewall daemon with time-based capabilities
+#	Copyright (C) 2020-2021 Johannes Bauer
+#
+#	This file is part of firewalld.
+#
+#	firewalld is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	firewalld is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with firewalld; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import unittest
+from pyipt.Firewall import HighlevelRule
+from pyipt.Variables import Variables
+
+class PortForwardTests(unittest.TestCase):
+	_CONFIG = {
+		"hosts":			{ "backend": "192.168.1.10" },
+		"interfaces":		{ "eth1": "external" },
+		"interfaces-rev":	{ "external": "eth1" },
+	}
+
+	@staticmethod
+	def _translated_port(ports, port):
+		# Port the kernel translates an incoming port to for a DNAT target
+		# '--to addr:min-max/base' (or a single port): the offset of the port
+		# from the base port is applied to the start of the range, modulo its
+		# size (nf_nat_range2.base_proto)
+		(to_range, _, base_port) = ports.partition("/")
+		(min_port, _, max_port) = to_range.partition("-")
+		if base_port == "":
+			return int(min_port)
+		return int(min_port) + ((port - int(base_port)) % (int(max_port) - int(min_port) + 1))
+
+	def _assert_per_port_equivalent(self, dest_service, forward_to, spans):
+		rule = HighlevelRule({ "action": "port-forward", "dest-ifaddr": "external", "dest-service": dest_service, "forward-to": forward_to }, self._CONFIG, Variables({ }))
+		for (begin_port, end_port) in spans:
+			ports = rule._dnat_ports(begin_port, end_port)
+			for port in range(begin_port, end_port + 1):
+				self.assertEqual(self._translated_port(ports, port), rule._forwarded_port(port), "port %d with DNAT to %s" % (port, ports))
+
+	def test_relative_up(self):
+		self._assert_per_port_equivalent("1200-1300/tcp, 1400/tcp", "backend:+1000", [ (1200, 1300), (1400, 1400) ])
+
+	def test_relative_down(self):
+		self._assert_per_port_equivalent("1200-1300/tcp", "backend:-1199", [ (1200, 1300) ])
+
+	def test_full_range(self):
+		self._assert_per_port_equivalent("1-65535/udp", "backend:+0", [ (1, 65535) ])
+
+	def test_absolute(self):
+		self._assert_per_port_equivalent("1400/tcp", "backend:8080", [ (1400, 1400) ])
+
+if __name__ == "__main__":
+	unittest.main()